@@ -3,6 +3,13 @@ from trytond.pool import Pool
 from invoice import Invoice, PayInvoiceUsingTransactionStart, \
     PayInvoiceUsingTransaction, PaymentTransaction, \
     PayInvoiceUsingTransactionFailed, AccountConfiguration
+from party import PaymentProfile
+from charge import ChargeRun, ChargeRunShard
+from event import PaymentEvent
+from notification import PaymentNotification
+from gateway import PaymentGateway
+from plan import PaymentPlan
+from profiling import User
 
 
 def register():
@@ -12,6 +19,14 @@ def register():
         PayInvoiceUsingTransactionStart,
         PayInvoiceUsingTransactionFailed,
         AccountConfiguration,
+        PaymentProfile,
+        ChargeRun,
+        ChargeRunShard,
+        PaymentEvent,
+        PaymentNotification,
+        PaymentGateway,
+        PaymentPlan,
+        User,
         module='invoice_payment_gateway', type_='model'
     )
     Pool.register(
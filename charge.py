@@ -0,0 +1,797 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import socket
+import time
+from decimal import Decimal
+
+from sql import Null
+from sql.aggregate import Min, Sum
+from sql.conditionals import Case
+from sql.operators import Mod
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import Workflow, ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+__all__ = ['ChargeRun', 'ChargeRunShard', 'ChargeBudget', 'ChargeItem']
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+}
+DEPENDS = ['state']
+
+
+class ChargeRun(Workflow, ModelSQL, ModelView):
+    'Charge Run'
+    __name__ = 'account.invoice.charge_run'
+
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, select=True,
+        states=STATES, depends=DEPENDS
+    )
+    shard_count = fields.Integer(
+        'Shards', required=True, states=STATES, depends=DEPENDS,
+        help='Number of parts the invoices are split into, by party. '
+        'Each part is charged by one worker at a time.'
+    )
+    chunk_size = fields.Integer(
+        'Chunk Size', required=True, states=STATES, depends=DEPENDS,
+        help='Number of invoices charged and committed at once.'
+    )
+    lease_duration = fields.Integer(
+        'Lease Duration', required=True, states=STATES, depends=DEPENDS,
+        help='Seconds after which a part claimed by a worker which stopped '
+        'responding can be claimed by another worker.'
+    )
+    priority = fields.Selection([
+        ('invoice', 'Invoice Order'),
+        ('amount', 'Largest Amount First'),
+        ('overdue', 'Most Overdue First'),
+    ], 'Priority', required=True, states=STATES, depends=DEPENDS,
+        help='Order in which the invoices of each gateway are charged.')
+    time_budget = fields.Integer(
+        'Time Budget', required=True, states=STATES, depends=DEPENDS,
+        help='Seconds the workers charge the run for from its start, 0 for '
+        'no limit.'
+    )
+    call_budget = fields.Integer(
+        'Call Budget', required=True, states=STATES, depends=DEPENDS,
+        help='Gateway calls the workers make for the run, 0 for no limit.'
+    )
+    deadline = fields.DateTime(
+        'Deadline', readonly=True,
+        help='Time after which no more invoices of the run are charged.'
+    )
+    calls_spent = fields.Integer(
+        'Gateway Calls', readonly=True,
+        help='Gateway calls reserved by the workers out of the call budget.'
+    )
+    shards = fields.One2Many(
+        'account.invoice.charge_run.shard', 'run', 'Shards', readonly=True
+    )
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+    ], 'State', readonly=True, select=True)
+    shards_done = fields.Function(
+        fields.Integer('Shards Done'), 'get_progress'
+    )
+    invoice_count = fields.Function(
+        fields.Integer('Invoices Processed'), 'get_progress'
+    )
+    charged_count = fields.Function(
+        fields.Integer('Invoices Charged'), 'get_progress'
+    )
+    failed_count = fields.Function(
+        fields.Integer('Charges Failed'), 'get_progress'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(ChargeRun, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._sql_constraints += [
+            ('shard_count_positive', 'CHECK(shard_count > 0)',
+                'The number of shards of a charge run must be positive.'),
+            ('chunk_size_positive', 'CHECK(chunk_size > 0)',
+                'The chunk size of a charge run must be positive.'),
+            ('lease_duration_positive', 'CHECK(lease_duration > 0)',
+                'The lease duration of a charge run must be positive.'),
+        ]
+        cls._transitions |= set((
+            ('draft', 'running'),
+            ('running', 'done'),
+        ))
+        cls._buttons.update({
+            'start': {
+                'invisible': Eval('state') != 'draft',
+            },
+        })
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_shard_count():
+        return 1
+
+    @staticmethod
+    def default_chunk_size():
+        return 100
+
+    @staticmethod
+    def default_lease_duration():
+        return 600
+
+    @staticmethod
+    def default_priority():
+        return 'invoice'
+
+    @staticmethod
+    def default_time_budget():
+        return 0
+
+    @staticmethod
+    def default_call_budget():
+        return 0
+
+    @staticmethod
+    def default_calls_spent():
+        return 0
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    def get_progress(cls, runs, names):
+        """
+        Aggregate the progress of the shards of the runs
+        """
+        pool = Pool()
+        Shard = pool.get('account.invoice.charge_run.shard')
+        shard = Shard.__table__()
+        cursor = Transaction().connection.cursor()
+
+        result = dict((n, dict((r.id, 0) for r in runs)) for n in names)
+        cursor.execute(*shard.select(
+            shard.run,
+            Sum(Case((shard.state == 'done', 1), else_=0)),
+            Sum(shard.invoice_count),
+            Sum(shard.charged_count),
+            Sum(shard.failed_count),
+            where=shard.run.in_([r.id for r in runs]),
+            group_by=shard.run
+        ))
+        for run_id, done, invoices, charged, failed in cursor.fetchall():
+            values = {
+                'shards_done': done,
+                'invoice_count': invoices or 0,
+                'charged_count': charged or 0,
+                'failed_count': failed or 0,
+            }
+            for name in names:
+                result[name][run_id] = values[name]
+        return result
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('running')
+    def start(cls, runs):
+        """
+        Split the runs into shards which workers can claim, and start the
+        time budget. The shards resume from the cursors of the previous
+        run stopped by its budget.
+        """
+        Shard = Pool().get('account.invoice.charge_run.shard')
+
+        now = datetime.datetime.now()
+        for run in runs:
+            if run.time_budget:
+                run.deadline = now + datetime.timedelta(
+                    seconds=run.time_budget
+                )
+            run.calls_spent = 0
+        cls.save(runs)
+        to_create = []
+        for run in runs:
+            cursors = run.get_resume_cursors()
+            to_create.extend({
+                'run': run.id,
+                'number': number,
+                'resume_cursor': cursors.get(number),
+            } for number in range(run.shard_count))
+        Shard.create(to_create)
+
+    def get_resume_cursors(self):
+        """
+        Return the cursors of the shards left unfinished by the previous
+        run of the company, when it was stopped by its budget, so that the
+        run resumes where it stopped. Only a previous run with the same
+        shards and priority can be resumed.
+
+        :return: Dictionary mapping shard numbers to cursors
+        """
+        previous = self.search([
+            ('company', '=', self.company.id),
+            ('id', '!=', self.id),
+            ('state', '=', 'done'),
+        ], order=[('id', 'DESC')], limit=1)
+        if not previous:
+            return {}
+        previous, = previous
+        if (previous.shard_count != self.shard_count
+                or previous.priority != self.priority):
+            return {}
+        return dict(
+            (s.number, s.resume_cursor) for s in previous.shards
+            if s.state != 'done'
+        )
+
+    @classmethod
+    @Workflow.transition('done')
+    def done(cls, runs):
+        pass
+
+    @classmethod
+    def finish(cls, runs):
+        """
+        Mark as done the running runs whose shards are all done, or whose
+        budget is spent and whose shards are no longer charged.
+
+        It must be called in a transaction started after the state of the
+        shards was committed, so that the last worker to finish a shard
+        sees all of them done. The runs are locked so that the workers
+        finishing at the same time do not both mark a run done.
+        """
+        pool = Pool()
+        Shard = pool.get('account.invoice.charge_run.shard')
+        table = cls.__table__()
+        shard = Shard.__table__()
+        cursor = Transaction().connection.cursor()
+
+        run_ids = [r.id for r in runs]
+        if not run_ids:
+            return
+        now = datetime.datetime.now()
+        query, params = table.select(
+            table.id, cls._budget_spent(table, now),
+            where=reduce_ids(table.id, run_ids) & (table.state == 'running')
+        )
+        if backend.name() == 'postgresql':
+            query += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(query, params)
+        locked = dict(cursor.fetchall())
+        if not locked:
+            return
+        cursor.execute(*shard.select(
+            shard.run,
+            Sum(Case((
+                (shard.state == 'running') & (shard.lease_expiration >= now),
+                1
+            ), else_=0)),
+            where=reduce_ids(shard.run, list(locked))
+            & (shard.state != 'done'),
+            group_by=shard.run
+        ))
+        pending = set(
+            run_id for run_id, leased in cursor.fetchall()
+            if not locked[run_id] or leased
+        )
+        cls.done(cls.browse([i for i in locked if i not in pending]))
+
+    @staticmethod
+    def _budget_spent(table, now):
+        "Return the SQL condition of the runs whose budget is spent"
+        return (
+            ((table.deadline != Null) & (table.deadline <= now))
+            | ((table.call_budget > 0)
+                & (table.calls_spent >= table.call_budget))
+        )
+
+    def reserve_calls(self, calls, unused=0):
+        """
+        Reserve gateway calls in the call budget shared by the workers of
+        the run, give back the unused calls of the last reservation, and
+        commit.
+
+        The budget is stored on the run, which serializes the reservations
+        of the workers: a reservation failing on concurrent update is
+        tried again.
+
+        :param calls: Number of calls wanted
+        :param unused: Number of calls reserved before but not made
+        :return: Number of calls reserved
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        table = self.__table__()
+        transaction = Transaction()
+
+        if not self.call_budget:
+            return calls
+        retry = config.getint('database', 'retry')
+        while True:
+            cursor = transaction.connection.cursor()
+            try:
+                query, params = table.select(
+                    table.calls_spent, where=table.id == self.id
+                )
+                if backend.name() == 'postgresql':
+                    query += ' FOR UPDATE'
+                cursor.execute(query, params)
+                spent, = cursor.fetchone()
+                spent -= unused
+                reserved = max(min(calls, self.call_budget - spent), 0)
+                cursor.execute(*table.update(
+                    [table.calls_spent], [spent + reserved],
+                    where=table.id == self.id
+                ))
+                transaction.commit()
+                return reserved
+            except DatabaseOperationalError:
+                transaction.rollback()
+                if retry <= 0:
+                    raise
+                retry -= 1
+
+    def get_invoice_ids(self, shard_number):
+        """
+        Return the ids of the invoices of a shard left to charge, in the
+        order of the priority of the run
+        """
+        return [i.invoice for i in self.get_charge_items(shard_number)]
+
+    def get_charge_items(self, shard_number):
+        """
+        Return the invoices of a shard left to charge, highest priority
+        first, as ChargeItem.
+
+        Invoices are assigned to shards by party, so that credit notes are
+        always netted by the worker charging the invoices of the party.
+
+        The priority is a number which does not change from one day to the
+        next, so that it can be stored in the cursor of a shard: the amount
+        to pay, or the opposite of the ordinal of the earliest maturity.
+        The amount to pay is computed like the field of the invoice, with
+        the payment lines.
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        invoice = Invoice.__table__()
+        line = MoveLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*invoice.join(
+            line, 'LEFT', condition=(line.move == invoice.move)
+            & (line.account == invoice.account)
+            & (line.reconciliation == Null)
+        ).select(
+            invoice.id, invoice.party, invoice.account,
+            Min(line.maturity_date),
+            where=(invoice.company == self.company.id)
+            & (invoice.type == 'out')
+            & (invoice.state == 'posted')
+            & (Mod(invoice.party, self.shard_count) == shard_number),
+            group_by=[invoice.id, invoice.party, invoice.account]
+        ))
+        result = []
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            amounts = Invoice._get_amounts_to_pay([r[0] for r in rows])
+            for invoice_id, party_id, account_id, maturity in rows:
+                amount, _ = amounts[invoice_id]
+                if self.priority == 'amount':
+                    priority = amount
+                elif self.priority == 'overdue':
+                    if isinstance(maturity, basestring):
+                        # SQLite returns the aggregated dates as strings
+                        maturity = datetime.date(
+                            *map(int, maturity.split('-')))
+                    priority = -(maturity or datetime.date.max).toordinal()
+                else:
+                    priority = 0
+                result.append(ChargeItem(
+                    invoice_id, party_id, account_id, amount, priority
+                ))
+        result.sort(key=lambda i: (-i.priority, i.invoice))
+        return result
+
+    def get_budget(self):
+        "Return the budget of the run shared by the workers"
+        return ChargeBudget(self)
+
+    @classmethod
+    def process(cls):
+        """
+        Claim the shards of the running charge runs one after the other and
+        charge their invoices, until no shard is left to claim. The shards
+        of the runs whose budget is spent are not claimed.
+
+        The runs whose shards are all done are then marked done, which
+        also closes the runs missed by workers finishing at the same time.
+
+        This method is meant to be called by the scheduler of every node.
+        """
+        Shard = Pool().get('account.invoice.charge_run.shard')
+
+        worker = '%s:%s' % (socket.gethostname(), os.getpid())
+        while True:
+            shard = Shard.claim(worker)
+            if shard is None:
+                break
+            budget = shard.run.get_budget()
+            shard.charge(worker, budget)
+            budget.close()
+        cls.finish(cls.search([('state', '=', 'running')]))
+        Transaction().commit()
+
+
+class ChargeRunShard(ModelSQL, ModelView):
+    'Charge Run Shard'
+    __name__ = 'account.invoice.charge_run.shard'
+
+    run = fields.Many2One(
+        'account.invoice.charge_run', 'Run', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    number = fields.Integer('Number', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+    ], 'State', readonly=True, select=True)
+    lease_owner = fields.Char('Lease Owner', readonly=True)
+    lease_expiration = fields.DateTime('Lease Expiration', readonly=True)
+    invoice_count = fields.Integer('Invoices Processed', readonly=True)
+    charged_count = fields.Integer('Invoices Charged', readonly=True)
+    failed_count = fields.Integer('Charges Failed', readonly=True)
+    resume_cursor = fields.Text(
+        'Resume Cursor', readonly=True,
+        help='Last invoice charged for each gateway, where the next worker '
+        'or the next run resumes.'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(ChargeRunShard, cls).__setup__()
+        cls._order.insert(0, ('number', 'ASC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_invoice_count():
+        return 0
+
+    @staticmethod
+    def default_charged_count():
+        return 0
+
+    @staticmethod
+    def default_failed_count():
+        return 0
+
+    @classmethod
+    def claim(cls, worker):
+        """
+        Claim a pending shard of a running charge run whose budget is not
+        spent, or a shard whose lease expired because its worker stopped,
+        and commit the lease so that the workers of other nodes see it.
+
+        :param worker: Identifier of the worker
+        :return: Active record of the claimed shard or None
+        """
+        pool = Pool()
+        Run = pool.get('account.invoice.charge_run')
+        table = cls.__table__()
+        run = Run.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        now = datetime.datetime.now()
+
+        where = (table.run.in_(run.select(
+                run.id, where=(run.state == 'running')
+                & ~Run._budget_spent(run, now)))
+            & ((table.state == 'pending')
+                | ((table.state == 'running')
+                    & ((table.lease_expiration == Null)
+                        | (table.lease_expiration < now)))))
+        query, params = table.select(
+            table.id, where=where, order_by=table.id, limit=1
+        )
+        if backend.name() == 'postgresql':
+            query += ' FOR UPDATE SKIP LOCKED'
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+        if not row:
+            return None
+
+        shard = cls(row[0])
+        expiration = now + datetime.timedelta(
+            seconds=shard.run.lease_duration
+        )
+        cursor.execute(*table.update(
+            [table.state, table.lease_owner, table.lease_expiration],
+            ['running', worker, expiration],
+            where=table.id == shard.id
+        ))
+        transaction.commit()
+        return shard
+
+    def renew_lease(
+        self, worker, invoices=0, charged=0, failed=0, position=None
+    ):
+        """
+        Extend the lease of the shard, add the progress of the last chunk
+        and commit.
+
+        :param worker: Identifier of the worker holding the lease
+        :param position: Dictionary mapping gateway ids to the priority and
+                         the id of the last invoice charged (optional)
+        :return: False if the lease expired, the shard may then be charged
+                 by another worker
+        """
+        table = self.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        now = datetime.datetime.now()
+        expiration = now + datetime.timedelta(
+            seconds=self.run.lease_duration
+        )
+        columns = [
+            table.lease_expiration,
+            table.invoice_count,
+            table.charged_count,
+            table.failed_count,
+        ]
+        values = [
+            expiration,
+            table.invoice_count + invoices,
+            table.charged_count + charged,
+            table.failed_count + failed,
+        ]
+        if position is not None:
+            columns.append(table.resume_cursor)
+            values.append(json.dumps(position, sort_keys=True))
+        cursor.execute(*table.update(
+            columns, values,
+            where=(table.id == self.id) & (table.lease_owner == worker)
+            & (table.lease_expiration >= now)
+        ))
+        renewed = bool(cursor.rowcount)
+        transaction.commit()
+        return renewed
+
+    def release(self, worker):
+        """
+        Give the shard back to be claimed by the next execution of the
+        scheduler and commit. The cursor saved by the last renewal of the
+        lease is kept.
+        """
+        table = self.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        cursor.execute(*table.update(
+            [table.state, table.lease_owner, table.lease_expiration],
+            ['pending', Null, Null],
+            where=(table.id == self.id) & (table.lease_owner == worker)
+        ))
+        transaction.commit()
+
+    def get_charge_order(self):
+        """
+        Return the invoices of the shard left to charge after the cursor,
+        as ChargeItem with their payment profile and gateway.
+
+        The invoices of each gateway are ordered by priority, and the
+        gateways take turns so that they share the capacity of the worker
+        fairly. Invoices of parties without a usable payment profile are
+        left out as there is nothing to charge.
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        items = self.run.get_charge_items(self.number)
+        # Keep only the ids of the profiles, a slice of parties at a time
+        profiles = {}
+        for party_ids in grouped_slice(list(set(i.party for i in items))):
+            usable, _ = PaymentProfile.get_charge_profiles(list(party_ids))
+            for party_id, profile in usable.items():
+                profiles[party_id] = (profile.id, profile.gateway.id)
+        position = json.loads(self.resume_cursor or '{}')
+
+        queues = {}
+        for item in items:
+            if item.party not in profiles:
+                continue
+            item.profile, item.gateway = profiles[item.party]
+            last = position.get(str(item.gateway))
+            if last and (-item.priority, item.invoice) <= (
+                    -Decimal(last[0]), last[1]):
+                continue
+            queues.setdefault(item.gateway, []).append(item)
+
+        order = []
+        depth = max([len(q) for q in queues.values()] or [0])
+        for index in range(depth):
+            for gateway_id in sorted(queues):
+                if index < len(queues[gateway_id]):
+                    order.append(queues[gateway_id][index])
+        return order
+
+    def charge(self, worker, budget=None):
+        """
+        Charge the invoices of the shard chunk by chunk, committing the
+        progress and the cursor and renewing the lease after each chunk.
+
+        The chunks are made small enough to be charged well within the
+        lease, from the time the previous ones took, so that the shard is
+        not reclaimed while a chunk is charged. The worker stops once the
+        lease is lost.
+
+        The gateway calls of each chunk are reserved in the budget of the
+        run first. When the budget is spent, the shard is given back and
+        the next worker resumes after the cursor. A shard reclaimed after a
+        crash also skips the invoices already paid.
+
+        Only the invoices of the chunk being charged are instantiated, the
+        others are carried as ChargeItem.
+
+        :param worker: Identifier of the worker holding the lease
+        :param budget: ChargeBudget of the run (optional)
+        :return: True if all the invoices of the shard were processed
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Run = pool.get('account.invoice.charge_run')
+        table = self.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        order = self.get_charge_order()
+        position = json.loads(self.resume_cursor or '{}')
+        chunk_size = self.run.chunk_size
+        lease_duration = self.run.lease_duration
+        renewed, seconds_per_invoice = time.time(), None
+        index = 0
+        while index < len(order):
+            if budget is not None and budget.exhausted:
+                self.release(worker)
+                return False
+            size = min(chunk_size, len(order) - index)
+            if seconds_per_invoice:
+                # Use at most half of the lease left
+                left = renewed + lease_duration - time.time()
+                size = max(min(size, int(left / 2 / seconds_per_invoice)), 1)
+            if budget is not None:
+                size = budget.limit(size)
+                if not size:
+                    self.release(worker)
+                    return False
+            chunk = order[index:index + size]
+            index += len(chunk)
+            start = time.time()
+            states = dict(
+                (t.origin.id, t.state)
+                for t in Invoice.batch_capture_and_pay(
+                    Invoice.browse([i.invoice for i in chunk]))
+            )
+            for item in chunk:
+                item.set_state(states.get(item.invoice))
+                position[str(item.gateway)] = [
+                    str(item.priority), item.invoice]
+            if budget is not None:
+                budget.spend(len(states))
+
+            seconds_per_invoice = (time.time() - start) / len(chunk)
+
+            charged = len([i for i in chunk if i.state == 'charged'])
+            if not self.renew_lease(
+                    worker, len(chunk), charged, len(states) - charged,
+                    position):
+                return False
+            renewed = time.time()
+
+        cursor.execute(*table.update(
+            [table.state, table.lease_owner, table.lease_expiration],
+            ['done', Null, Null],
+            where=(table.id == self.id) & (table.lease_owner == worker)
+            & (table.lease_expiration >= datetime.datetime.now())
+        ))
+        finished = bool(cursor.rowcount)
+        transaction.commit()
+        if finished:
+            Run.finish([self.run])
+            transaction.commit()
+        return finished
+
+
+class ChargeBudget(object):
+    """
+    Time and gateway calls left to the workers of a charge run, shared
+    through the deadline and the calls spent stored on the run
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.deadline = run.deadline
+        self.reserved = 0
+        self.unused = 0
+
+    @property
+    def exhausted(self):
+        if (self.deadline is not None
+                and datetime.datetime.now() >= self.deadline):
+            return True
+        if not self.run.call_budget:
+            return False
+        table = self.run.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(
+            table.calls_spent, where=table.id == self.run.id
+        ))
+        spent, = cursor.fetchone()
+        return spent - self.unused >= self.run.call_budget
+
+    def limit(self, size):
+        """
+        Reserve the gateway calls of the next chunk on the run and return
+        its number of invoices
+        """
+        self.reserved = self.run.reserve_calls(size, self.unused)
+        self.unused = 0
+        return self.reserved
+
+    def spend(self, calls):
+        "Record the calls made out of the last reservation"
+        self.unused = max(self.reserved - calls, 0)
+        self.reserved = 0
+
+    def close(self):
+        "Give back to the run the calls reserved but not made"
+        if self.unused:
+            self.run.reserve_calls(0, self.unused)
+            self.unused = 0
+
+
+class ChargeItem(object):
+    """
+    Invoice of a charge run waiting to be charged, carried between the
+    stages of the run instead of the active record.
+    """
+    __slots__ = (
+        'invoice', 'party', 'account', 'amount', 'priority', 'profile',
+        'gateway', 'state',
+    )
+
+    def __init__(self, invoice, party, account, amount, priority):
+        self.invoice = invoice
+        self.party = party
+        self.account = account
+        self.amount = amount
+        self.priority = priority
+        self.profile = None
+        self.gateway = None
+        self.state = 'pending'
+
+    def set_state(self, transaction_state):
+        "Set the state from the state of the capture transaction, if any"
+        if transaction_state is None:
+            self.state = 'skipped'
+        elif transaction_state in ('completed', 'posted'):
+            self.state = 'charged'
+        else:
+            self.state = 'failed'
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+from functools import wraps
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentEvent', 'buffer_payment_events']
+
+_local = threading.local()
+
+
+def buffer_payment_events(func):
+    """
+    Decorator buffering the payment events recorded by the decorated method
+    and inserting them with multi-row inserts when it returns. Events of a
+    method raising an exception are dropped with its transaction.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'buffer', None) is not None:
+            # Flushed by the outermost decorated method
+            return func(*args, **kwargs)
+        PaymentEvent = Pool().get('account.invoice.payment_event')
+        _local.buffer = []
+        try:
+            result = func(*args, **kwargs)
+            PaymentEvent.flush()
+            return result
+        finally:
+            _local.buffer = None
+    return wrapper
+
+
+class PaymentEvent(ModelSQL, ModelView):
+    'Invoice Payment Event'
+    __name__ = 'account.invoice.payment_event'
+
+    date = fields.DateTime('Date', required=True, readonly=True, select=True)
+    event = fields.Selection([
+        ('created', 'Created'),
+        ('authorized', 'Authorized'),
+        ('captured', 'Captured'),
+        ('refunded', 'Refunded'),
+        ('cancelled', 'Cancelled'),
+        ('failed', 'Failed'),
+        ('chargeback', 'Chargeback'),
+        ('paid', 'Paid'),
+        ('reconciled', 'Reconciled'),
+        ('write_off_skipped', 'Write-Off Skipped'),
+    ], 'Event', required=True, readonly=True)
+    invoice = fields.Many2One(
+        'account.invoice', 'Invoice', readonly=True, select=True,
+        ondelete='RESTRICT'
+    )
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True,
+        select=True, ondelete='RESTRICT'
+    )
+    amount = fields.Numeric('Amount', digits=(16, 4), readonly=True)
+    message = fields.Char('Message', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentEvent, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._order.insert(1, ('id', 'DESC'))
+
+    @classmethod
+    def record(
+        cls, event, invoice=None, transaction=None, amount=None,
+        message=None
+    ):
+        """
+        Record a payment event. Inside a method decorated with
+        `buffer_payment_events`, the event is kept in memory until the
+        method returns, otherwise it is inserted at once.
+
+        :param event: Name of the event
+        :param invoice: Invoice (active record or id)
+        :param transaction: Payment transaction (active record or id)
+        :param amount: Amount of the event
+        :param message: Short description
+        """
+        values = (
+            datetime.datetime.now(), event,
+            int(invoice) if invoice is not None else None,
+            int(transaction) if transaction is not None else None,
+            amount, message,
+        )
+        buffer = getattr(_local, 'buffer', None)
+        if buffer is None:
+            cls._insert([values])
+        else:
+            buffer.append(values)
+
+    @classmethod
+    def record_transactions(cls, event, transactions, message=None):
+        """
+        Record an event for each payment transaction, linked to the invoice
+        when it is the origin of the transaction.
+        """
+        for transaction in transactions:
+            origin = transaction.origin
+            cls.record(
+                event,
+                invoice=origin if getattr(
+                    origin, '__name__', None) == 'account.invoice' else None,
+                transaction=transaction, amount=transaction.amount,
+                message=message
+            )
+
+    @classmethod
+    def record_results(
+        cls, event, transactions, operation, states=('completed', 'posted')
+    ):
+        """
+        Record the event for the transactions which reached one of the
+        states, and a failure of the operation for the others.
+        """
+        cls.record_transactions(
+            event, [t for t in transactions if t.state in states]
+        )
+        cls.record_transactions(
+            'failed', [t for t in transactions if t.state not in states],
+            message=operation
+        )
+
+    @classmethod
+    def flush(cls):
+        "Insert the buffered events"
+        buffer = getattr(_local, 'buffer', None)
+        if buffer:
+            cls._insert(buffer)
+            del buffer[:]
+
+    @classmethod
+    def _insert(cls, rows):
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        now = datetime.datetime.now()
+
+        for sub_rows in grouped_slice(rows):
+            cursor.execute(*table.insert([
+                table.create_uid, table.create_date,
+                table.date, table.event, table.invoice, table.transaction,
+                table.amount, table.message,
+            ], [
+                [transaction.user, now] + list(row) for row in sub_rows
+            ]))
+
+    @classmethod
+    def write(cls, *args):
+        cls.raise_user_error('Payment events can not be modified')
+
+    @classmethod
+    def delete(cls, events):
+        cls.raise_user_error('Payment events can not be deleted')
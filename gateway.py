@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import hmac
+from decimal import Decimal
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import fields
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentGateway', 'RateTable']
+__metaclass__ = PoolMeta
+
+
+class PaymentGateway:
+    __name__ = 'payment_gateway.gateway'
+
+    settlement_currency = fields.Many2One(
+        'currency.currency', 'Settlement Currency',
+        help='Charge the invoices in other currencies in this currency, '
+        'converted at the rate of the day. Leave empty to charge in the '
+        'currency of the invoice.'
+    )
+    _user_gateways_cache = Cache(
+        'payment_gateway.gateway.user_gateways', context=False
+    )
+
+    @classmethod
+    def get_user_gateways(cls, user_id):
+        "Return the ids of the gateways of the user"
+        gateway_ids = cls._user_gateways_cache.get(user_id)
+        if gateway_ids is None:
+            gateway_ids = [g.id for g in cls.search([
+                ('users', '=', user_id),
+            ], order=[('id', 'ASC')])]
+            cls._user_gateways_cache.set(user_id, gateway_ids)
+        return gateway_ids
+
+    def verify_notification(self, payload, signature):
+        """
+        Return whether the signature of the payload of a notification was
+        made by the gateway.
+
+        Each provider checks the signature in a method named
+        `verify_notification_<provider>`. The notifications of providers
+        without one are rejected.
+        """
+        method = getattr(self, 'verify_notification_%s' % self.provider, None)
+        if method is None or not signature:
+            return False
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        return method(payload, signature)
+
+    def verify_notification_dummy(self, payload, signature):
+        "Check the HMAC-SHA256 of the payload with the configured secret"
+        secret = config.get(
+            'invoice_payment_gateway', 'dummy_notification_secret'
+        )
+        if not secret:
+            return False
+        digest = hmac.new(secret, payload, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(digest, str(signature))
+
+    @classmethod
+    def _clear_caches(cls):
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        cls._user_gateways_cache.clear()
+        # Profiles of inactive gateways can not be charged
+        PaymentProfile._default_profile_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        gateways = super(PaymentGateway, cls).create(vlist)
+        cls._clear_caches()
+        return gateways
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentGateway, cls).write(*args)
+        cls._clear_caches()
+
+    @classmethod
+    def delete(cls, gateways):
+        super(PaymentGateway, cls).delete(gateways)
+        cls._clear_caches()
+
+
+class RateTable(object):
+    """
+    Currency rates cached per date and currency pair, so that the charges
+    of a batch look up each rate once.
+    """
+
+    def __init__(self):
+        self._rates = {}
+
+    def get_rate(self, from_currency, to_currency, date):
+        "Return the rate converting from_currency to to_currency at the date"
+        key = (date, from_currency.id, to_currency.id)
+        if key not in self._rates:
+            Currency = Pool().get('currency.currency')
+            with Transaction().set_context(date=date):
+                self._rates[key] = Currency.compute(
+                    Currency(from_currency.id), Decimal('1'),
+                    Currency(to_currency.id), round=False
+                )
+        return self._rates[key]
+
+    def compute(self, from_currency, amount, to_currency, date):
+        "Convert the amount like `currency.currency.compute`"
+        if from_currency == to_currency:
+            return amount
+        return to_currency.round(
+            amount * self.get_rate(from_currency, to_currency, date)
+        )
@@ -1,25 +1,78 @@
 # -*- coding: utf-8 -*-
+import csv
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import time
 from decimal import Decimal
+from itertools import groupby
 
+from sql import Cast, Join, Literal, Null
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Position, Substring
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.pool import PoolMeta, Pool
 from trytond.exceptions import UserError
-from trytond.model import fields, ModelView
+from trytond.filestore import filestore
+from trytond.model import fields, ModelView, Workflow
 from trytond.pyson import Eval, Bool, And, Or, Id, Not, If
 from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 
 from trytond.modules.payment_gateway.transaction import BaseCreditCardViewMixin
 
+from event import buffer_payment_events
+from gateway import RateTable
+from profiling import profile_payment
+from routing import gateway_health
+
 __all__ = [
     'Invoice', 'PayInvoiceUsingTransactionStart', 'PayInvoiceUsingTransaction',
     'PaymentTransaction', 'PayInvoiceUsingTransactionFailed'
 ]
 __metaclass__ = PoolMeta
 
+# SQLSTATE of the rows locked by another transaction with NOWAIT
+LOCK_NOT_AVAILABLE = '55P03'
+# Size of the chunks of the files copied to the filestore
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def _store_file(file_, prefix):
+    """
+    Copy the file by chunks into the default filestore, at the path the
+    filestore gives to its content, and return its id.
+    """
+    file_.seek(0)
+    digest = hashlib.md5()
+    for chunk in iter(lambda: file_.read(FILE_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file_id = digest.hexdigest()
+
+    filename = filestore._filename(file_id, prefix)
+    if not os.path.exists(filename):
+        dirname = os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname, 0o770)
+        file_.seek(0)
+        with open(filename, 'wb') as target:
+            shutil.copyfileobj(file_, target, FILE_CHUNK_SIZE)
+    return file_id
+
 
 class Invoice:
     __name__ = 'account.invoice'
+    _payment_balances_cache = Cache(
+        'account.invoice.payment_balances', context=False
+    )
 
     @classmethod
     def __setup__(cls):
@@ -38,8 +91,21 @@ class Invoice:
             'capture_and_pay_using_transaction': RPC(
                 readonly=False, instantiate=0
             ),
+            'batch_capture_and_pay': RPC(
+                readonly=False, instantiate=0
+            ),
+            'net_credit_notes': RPC(
+                readonly=False, instantiate=0
+            ),
+            'simulate_batch_capture': RPC(readonly=False, instantiate=0),
+            'get_unusable_payment_profiles': RPC(instantiate=0),
+            'export_gateway_payments': RPC(readonly=False),
+            'get_payment_balances': RPC(instantiate=0),
+            'get_party_payment_balances': RPC(),
         })
 
+    @profile_payment
+    @buffer_payment_events
     def capture_and_pay_using_transaction(self, profile_id, gateway_id, amount):
         """
         Create a payment transaction, capture paymnet and then pay using
@@ -50,37 +116,1238 @@ class Invoice:
         :param amount: Amount to be deducted
         """
         PaymentTransaction = Pool().get('payment_gateway.transaction')
+        AccountConfiguration = Pool().get('account.configuration')
+
+        self.lock_for_payment([self])
+        self.check_not_offset([self])
+        if AccountConfiguration(1).gateway_routing:
+            profile_id, gateway_id = self._route_payment_profile(
+                profile_id, gateway_id
+            )
+        transaction = self._get_payment_transaction(
+            profile_id, gateway_id, amount
+        )
+        transaction.save()
+        PaymentTransaction.capture_and_monitor([transaction])
+        if transaction.state in ('completed', 'posted'):
+            self.pay_using_transaction(transaction)
+        else:
+            self.raise_user_error('Payment capture failed')
+
+    def _get_payment_transaction(
+        self, payment_profile, gateway, amount, rates=None
+    ):
+        """
+        Return an unsaved charge transaction for this invoice
+
+        :param payment_profile: Payment profile (active record or id)
+        :param gateway: Payment gateway (active record or id)
+        :param amount: Amount to be deducted
+        :param rates: RateTable shared by the charges of a batch (optional)
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
         Date = Pool().get('ir.date')
 
-        transaction = PaymentTransaction(
+        currency, amount = self.get_charge_amount(gateway, amount, rates)
+        return PaymentTransaction(
+            origin='%s,%s' % (self.__name__, self.id),
             party=self.party,
             credit_account=self.party.account_receivable,
             address=self.invoice_address,
-            gateway=gateway_id,
-            payment_profile=profile_id,
+            gateway=gateway,
+            payment_profile=payment_profile,
             amount=amount,
-            currency=self.currency,
+            currency=currency,
             description=self.description,
             date=Date.today(),
         )
-        transaction.save()
-        PaymentTransaction.capture([transaction])
-        if transaction.state in ('completed', 'posted'):
-            self.pay_using_transaction(transaction)
-        else:
-            self.raise_user_error('Payment capture failed')
 
-    def pay_using_transaction(self, payment_transaction):
+    def get_charge_amount(self, gateway, amount, rates=None):
         """
-        Pay an invoice using an existing payment_transaction
+        Return the currency and the amount to charge on the gateway for an
+        amount in the currency of the invoice. Gateways with a settlement
+        currency are charged in it, at the rate of the day.
 
-        :param payment_transaction: Active record of a payment transaction
+        :param gateway: Payment gateway (active record or id)
+        :param amount: Amount in the currency of the invoice
+        :param rates: RateTable shared by the charges of a batch (optional)
         """
+        Gateway = Pool().get('payment_gateway.gateway')
         Date = Pool().get('ir.date')
-        AccountMoveLine = Pool().get('account.move.line')
+
+        currency = Gateway(int(gateway)).settlement_currency
+        if not currency or currency == self.currency:
+            return self.currency, amount
+        if rates is None:
+            rates = RateTable()
+        return currency, rates.compute(
+            self.currency, amount, currency, Date.today()
+        )
+
+    def _route_payment_profile(self, profile_id, gateway_id):
+        """
+        Return the payment profile and gateway to capture with: the given
+        ones while the gateway is healthy, otherwise another usable profile
+        of the party on the healthiest gateway. The other profiles are
+        tried newest first when their gateways are as healthy.
+
+        :param profile_id: Payment profile id
+        :param gateway_id: Payment gateway id
+        :return: Tuple of payment profile id and gateway id
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        candidates = [(profile_id, gateway_id)]
+        for profile in PaymentProfile.get_routable_profiles(
+                [self.party.id])[self.party.id]:
+            if profile.id != profile_id:
+                candidates.append((profile.id, profile.gateway.id))
+
+        gateway_ids = []
+        for _, candidate_gateway_id in candidates:
+            if candidate_gateway_id not in gateway_ids:
+                gateway_ids.append(candidate_gateway_id)
+        routed_gateway_id = gateway_health.route(
+            gateway_ids, preferred=gateway_id
+        )
+        if routed_gateway_id is None:
+            self.raise_user_error(
+                'No payment gateway is available for the party, '
+                'try again later'
+            )
+        for candidate in candidates:
+            if candidate[1] == routed_gateway_id:
+                return candidate
+
+    def get_default_payment_profile(self, gateway=None):
+        """
+        Return the payment profile used to charge the invoice without user
+        interaction: the latest usable profile of the party, optionally
+        restricted to a gateway.
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        profiles, _ = PaymentProfile.get_charge_profiles(
+            [self.party.id], gateway=gateway
+        )
+        return profiles.get(self.party.id)
+
+    def create_refund_transactions(self, amount, gateway=None):
+        """
+        Create the refund transactions to refund the amount from the
+        captured charges of the party.
+
+        The refund is split over the charges newest first, starting with
+        the charges of this invoice. The charges are fetched and their
+        amount available for refund read by pages, until the amount is
+        covered. Charges made in the settlement currency of their gateway
+        are refunded in it, converted at the rate of the day.
+
+        :param amount: Amount to be refunded, in the currency of the invoice
+        :param gateway: Only refund charges of this gateway (optional)
+        :return: List of active records of the refund transactions
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        self.check_not_offset([self])
+        currency_ids = set([self.currency.id])
+        currency_ids.update(g.settlement_currency.id for g in Gateway.search([
+            ('settlement_currency', '!=', None),
+        ]))
+        domain = [
+            ('party', '=', self.party.id),
+            ('currency', 'in', list(currency_ids)),
+            ('type', '=', 'charge'),
+            ('state', 'in', ('completed', 'posted')),
+        ]
+        if gateway is not None:
+            domain.append(('gateway', '=', int(gateway)))
+        origin = '%s,%s' % (self.__name__, self.id)
+
+        refund_transactions = []
+        remaining = abs(amount)
+        rates = RateTable()
+        for origin_domain in [
+                [('origin', '=', origin)],
+                ['OR', ('origin', '!=', origin), ('origin', '=', None)]]:
+            if remaining <= 0:
+                break
+            for charge, available in self._get_refundable_charges(
+                    domain + [origin_domain]):
+                refund_amount, refunded = self._get_refund_amount(
+                    charge, available, remaining, rates
+                )
+                if refund_amount <= 0:
+                    continue
+                refund_transactions.append(charge.create_refund(refund_amount))
+                remaining -= refunded
+                if remaining <= 0:
+                    break
+
+        if remaining > 0:
+            self.raise_user_error(
+                'Captured payments of the party are not enough to refund %s'
+                % abs(amount)
+            )
+        return refund_transactions
+
+    def _get_refund_amount(self, charge, available, remaining, rates):
+        """
+        Return the amount to refund from the charge, in its currency, and
+        the amount it refunds in the currency of the invoice.
+
+        :param charge: Active record of the charge
+        :param available: Amount available for refund of the charge
+        :param remaining: Amount left to refund in the currency of the
+                          invoice
+        :param rates: RateTable shared by the refunds
+        """
+        Date = Pool().get('ir.date')
+
+        today = Date.today()
+        available_here = rates.compute(
+            charge.currency, available, self.currency, today
+        )
+        if available_here <= remaining:
+            return available, available_here
+        return min(available, rates.compute(
+            self.currency, remaining, charge.currency, today
+        )), remaining
+
+    @staticmethod
+    def _get_refundable_charges(domain):
+        """
+        Yield the charges of the domain newest first, with their amount
+        available for refund.
+
+        The charges are searched by pages growing from a few charges, as
+        the latest ones usually cover the refund, and the amounts of each
+        page are read at once.
+
+        :param domain: Domain of the charges
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        offset, limit = 0, 10
+        while True:
+            charges = PaymentTransaction.search(
+                domain, offset=offset, limit=limit,
+                order=[('date', 'DESC'), ('id', 'DESC')]
+            )
+            amounts = dict(
+                (r['id'], r['amount_available_for_refund'])
+                for r in PaymentTransaction.read(
+                    [c.id for c in charges], ['amount_available_for_refund'])
+            )
+            for charge in charges:
+                yield charge, amounts[charge.id]
+            if len(charges) < limit:
+                return
+            offset += limit
+            limit = min(limit * 2, Transaction().database.IN_MAX)
+
+    @classmethod
+    def post(cls, invoices):
+        super(Invoice, cls).post(invoices)
+        cls.authorize_payment_transactions(invoices)
+
+    @classmethod
+    @buffer_payment_events
+    def authorize_payment_transactions(cls, invoices):
+        """
+        Authorize the amount to pay of customer invoices against the default
+        payment profile of their party, when enabled in the account
+        configuration. The authorizations are captured later in bulk by
+        `capture_authorized_transactions`.
+
+        :param invoices: List of active records of invoices
+        :return: List of authorization transactions
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        PaymentEvent = Pool().get('account.invoice.payment_event')
+        AccountConfiguration = Pool().get('account.configuration')
+
+        config = AccountConfiguration(1)
+        if not config.authorize_on_post:
+            return []
+
+        transactions = []
+        rates = RateTable()
+        offset_ids = cls.get_offset_invoice_ids(invoices)
+        for invoice in invoices:
+            if invoice.type != 'out' or invoice.state != 'posted':
+                continue
+            if invoice.id in offset_ids:
+                # Settled with the invoice it was netted against
+                continue
+            if invoice.amount_to_pay <= 0:
+                # Credit notes are refunded, never authorized
+                continue
+            profile = invoice.get_default_payment_profile()
+            if not profile:
+                continue
+            transactions.append(invoice._get_payment_transaction(
+                profile, profile.gateway, invoice.amount_to_pay, rates
+            ))
+        if transactions:
+            PaymentTransaction.save(transactions)
+            PaymentEvent.record_transactions('created', transactions)
+            PaymentTransaction.authorize(transactions)
+            PaymentEvent.record_results(
+                'authorized', transactions, 'authorization',
+                states=('authorized',)
+            )
+        return transactions
+
+    @classmethod
+    @buffer_payment_events
+    def capture_authorized_transactions(cls):
+        """
+        Capture in bulk the authorizations taken when invoices were posted
+        and pay the invoices with the captured transactions.
+
+        Authorizations are captured once the invoice has an amount due
+        today. Authorizations which expire before, according to the
+        authorization validity of the account configuration, are cancelled
+        and the invoices authorized again. Authorizations of invoices which
+        are no longer posted, were paid by other means or were netted
+        against another invoice, are cancelled.
+
+        This method is meant to be called by the scheduler.
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        PaymentEvent = Pool().get('account.invoice.payment_event')
+
+        authorizations = PaymentTransaction.search([
+            ('origin', 'like', cls.__name__ + ',%'),
+            ('type', '=', 'charge'),
+            ('state', '=', 'authorized'),
+        ], order=[('gateway', 'ASC'), ('id', 'ASC')])
+
+        # Skip the invoices being paid by another worker
+        locked = cls.lock_for_payment(
+            list(set(t.origin for t in authorizations)), skip_locked=True
+        )
+        locked_ids = set(i.id for i in locked)
+        offset_ids = cls.get_offset_invoice_ids(locked)
+        expiry = cls._get_authorization_expiry()
+
+        to_capture, to_cancel, to_renew = [], [], []
+        for transaction in authorizations:
+            invoice = transaction.origin
+            if invoice.id not in locked_ids:
+                continue
+            if (invoice.state != 'posted' or invoice.amount_to_pay <= 0
+                    or invoice.id in offset_ids):
+                to_cancel.append(transaction)
+            elif expiry and transaction.date <= expiry:
+                to_renew.append(transaction)
+            elif invoice.amount_to_pay_today > 0:
+                to_capture.append(transaction)
+
+        if to_cancel or to_renew:
+            PaymentTransaction.cancel(to_cancel + to_renew)
+            PaymentEvent.record_transactions('cancelled', to_cancel + to_renew)
+        to_capture.extend(
+            t for t in cls.authorize_payment_transactions(
+                [t.origin for t in to_renew])
+            if t.state == 'authorized' and t.origin.amount_to_pay_today > 0
+        )
+        PaymentTransaction.settle_batch(to_capture)
+        PaymentEvent.record_results('captured', to_capture, 'settlement')
+
+        for transaction in to_capture:
+            if transaction.state in ('completed', 'posted'):
+                transaction.origin.pay_using_transaction(transaction)
+        return to_capture
+
+    @classmethod
+    def _get_authorization_expiry(cls):
+        """
+        Return the latest date of the authorizations to renew, as the
+        gateways expire them at the end of the authorization validity, or
+        None when they do not expire. They are renewed on their last day.
+        """
+        Date = Pool().get('ir.date')
+        AccountConfiguration = Pool().get('account.configuration')
+
+        validity = AccountConfiguration(1).authorization_validity
+        if not validity:
+            return None
+        return Date.today() - datetime.timedelta(days=validity - 1)
+
+    @classmethod
+    @buffer_payment_events
+    def batch_capture_and_pay(cls, invoices, payment_profiles=None):
+        """
+        Charge the amount to pay today of customer invoices on the default
+        payment profile of their party, and pay them with the captured
+        transactions.
+
+        Open credit notes of the parties are netted against their invoices
+        first, so that the gateway is only charged for the net amount.
+
+        :param invoices: List of active records of invoices
+        :param payment_profiles: Dictionary mapping invoice ids to the
+                                 payment profile to charge instead of the
+                                 default one of the party (optional)
+        :return: List of active records of the capture transactions
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+        AccountConfiguration = Pool().get('account.configuration')
+        Date = Pool().get('ir.date')
+
+        threshold = AccountConfiguration(1).write_off_threshold
+        today = Date.today()
+        if payment_profiles is None:
+            payment_profiles = {}
+        # Skip the invoices being paid by another worker
+        invoices = cls.lock_for_payment(invoices, skip_locked=True)
+        cls.net_credit_notes(invoices)
+        offset_ids = cls.get_offset_invoice_ids(invoices)
+        profiles = cls._get_batch_payment_profiles(set(
+            i.party.id for i in invoices if i.id not in payment_profiles
+        ))
+
+        transactions = []
+        rates = RateTable()
+        for invoice in invoices:
+            if not invoice._is_batch_chargeable(offset_ids, threshold):
+                continue
+            if invoice.id in payment_profiles:
+                profile = payment_profiles[invoice.id]
+                if profile.get_unusable_reason(today) is not None:
+                    continue
+            else:
+                profile = profiles.get(invoice.party.id)
+            if not profile:
+                continue
+            transactions.append(invoice._get_payment_transaction(
+                profile, profile.gateway, invoice.amount_to_pay_today, rates
+            ))
+        if not transactions:
+            return []
+        PaymentTransaction.save(transactions)
+        PaymentTransaction.capture_and_monitor(transactions)
+
+        for transaction in transactions:
+            if transaction.state in ('completed', 'posted'):
+                transaction.origin.pay_using_transaction(transaction)
+        return transactions
+
+    @classmethod
+    def _get_batch_payment_profiles(cls, party_ids):
+        """
+        Return the payment profile to charge in a batch capture for each
+        party: its latest usable profile, or when gateway routing is
+        enabled, its latest usable profile on the healthiest gateway.
+
+        Expired or unusable profiles are left out before calling the
+        gateway.
+
+        :param party_ids: List of party ids
+        :return: Dictionary mapping party ids to payment profiles
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
         AccountConfiguration = Pool().get('account.configuration')
 
+        if not AccountConfiguration(1).gateway_routing:
+            profiles, _ = PaymentProfile.get_charge_profiles(party_ids)
+            return profiles
+        profiles = {}
+        for party_id, candidates in PaymentProfile.get_routable_profiles(
+                party_ids).items():
+            profile = cls._route_payment_profiles(candidates)
+            if profile:
+                profiles[party_id] = profile
+        return profiles
+
+    @staticmethod
+    def _route_payment_profiles(profiles):
+        """
+        Return the first of the profiles while its gateway is healthy,
+        otherwise the first one on the healthiest gateway, or None when no
+        gateway is available.
+        """
+        gateway_ids = []
+        for profile in profiles:
+            if profile.gateway.id not in gateway_ids:
+                gateway_ids.append(profile.gateway.id)
+        if not gateway_ids:
+            return None
+        gateway_id = gateway_health.route(
+            gateway_ids, preferred=gateway_ids[0]
+        )
+        for profile in profiles:
+            if profile.gateway.id == gateway_id:
+                return profile
+
+    def _is_batch_chargeable(self, offset_ids, threshold):
+        """
+        Return whether a batch capture charges the invoice: a posted
+        customer invoice, not netted against another one, with an amount
+        to pay today above the write-off threshold.
+        """
+        return (
+            self.type == 'out' and self.state == 'posted'
+            and self.id not in offset_ids
+            and self.amount_to_pay_today > threshold
+        )
+
+    @classmethod
+    def simulate_batch_capture(cls, invoices, detail=False):
+        """
+        Compute what `batch_capture_and_pay` would charge, without calling
+        any gateway nor changing any invoice.
+
+        The plan is computed with a few queries per chunk of invoices, so
+        that hundreds of thousands of invoices are simulated in seconds.
+        Netting of credit notes is not simulated: the invoices of parties
+        with open credit notes are charged for less.
+
+        With detail, the plan of each invoice is written as it comes to a
+        CSV file attached to the company of the context, like
+        `export_gateway_payments`.
+
+        :param invoices: List of active records of invoices
+        :param detail: Attach the plan of each invoice too
+        :return: Dictionary with the number of invoices, the charges per
+                 gateway and currency and the number of skipped invoices
+                 per reason, and with detail, the id of the attachment
+                 listing the invoices with their number, party, currency,
+                 amount, gateway, payment profile and status
+        """
+        company_id = Transaction().context.get('company')
+        if detail and not company_id:
+            cls.raise_user_error(
+                'The batch capture can only be simulated in detail for a '
+                'company'
+            )
+        charges, skipped = {}, {}
+        count = 0
+        with tempfile.TemporaryFile() as detail_file:
+            writer = csv.writer(detail_file)
+            writer.writerow([
+                'invoice', 'number', 'party', 'currency', 'amount',
+                'gateway', 'payment_profile', 'status',
+            ])
+            for row in cls._get_charge_plan([i.id for i in invoices]):
+                count += 1
+                cls._add_simulated_charge(charges, skipped, row)
+                if detail:
+                    writer.writerow([
+                        row['invoice'], (row['number'] or '').encode('utf-8'),
+                        row['party'], row['currency_code'], row['amount'],
+                        (row['gateway_name'] or '').encode('utf-8'),
+                        row['payment_profile'], row['status'],
+                    ])
+
+            result = {
+                'invoices': count,
+                'charges': [charges[k] for k in sorted(charges)],
+                'skipped': skipped,
+            }
+            if detail:
+                now = datetime.datetime.now()
+                result['detail'] = cls._attach_file(
+                    detail_file, 'batch-capture-simulation-%s.csv'
+                    % now.strftime('%Y%m%d%H%M%S%f'),
+                    'company.company,%s' % company_id
+                )
+        return result
+
+    @staticmethod
+    def _add_simulated_charge(charges, skipped, row):
+        """
+        Add the row of a charge plan to the charges per gateway and currency,
+        or to the invoices skipped per reason
+        """
+        if row['status'] != 'charge':
+            skipped[row['status']] = skipped.get(row['status'], 0) + 1
+            return
+        key = (row['gateway_name'], row['currency_code'])
+        charge = charges.setdefault(key, {
+            'gateway': row['gateway_name'],
+            'currency': row['currency_code'],
+            'count': 0,
+            'amount': Decimal('0'),
+        })
+        charge['count'] += 1
+        charge['amount'] += row['amount']
+
+    @classmethod
+    def get_payment_balances(cls, invoices):
+        """
+        Return for each invoice what the pay wizard pre-fills, with the
+        usable payment profiles of the party, for the payment portals.
+
+        The amounts are computed with a few queries per slice of invoices
+        and cached for `balance_cache_duration` seconds, or until a payment
+        is added to an invoice.
+
+        Invoices netted against another invoice are settled with it: their
+        amounts are zero and they are flagged as offset.
+
+        :param invoices: List of active records of invoices
+        :return: List of dictionaries with the invoice id and number, the
+                 party id, the amount to pay, the amount to pay today, the
+                 amount and transaction type (charge or refund) of the
+                 wizard, the currency digits, whether the invoice is offset
+                 and the payment profiles
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        PaymentProfile = pool.get('party.payment_profile')
+        invoice = cls.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().connection.cursor()
+
+        now = time.time()
+        duration = config.getint(
+            'invoice_payment_gateway', 'balance_cache_duration', default=30
+        )
+        balances, missing = {}, []
+        for record in invoices:
+            cached = cls._payment_balances_cache.get(record.id)
+            if cached and now - cached[0] < duration:
+                balances[record.id] = cached[1]
+            else:
+                missing.append(record.id)
+
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            amounts = cls._get_amounts_to_pay(sub_ids)
+            offset_ids = cls.get_offset_invoice_ids(cls.browse(sub_ids))
+            cursor.execute(*invoice.join(
+                currency, condition=currency.id == invoice.currency
+            ).select(
+                invoice.id, invoice.number, invoice.party, currency.digits,
+                where=reduce_ids(invoice.id, sub_ids)
+            ))
+            for invoice_id, number, party_id, digits in cursor.fetchall():
+                if invoice_id in offset_ids:
+                    amount_to_pay = amount_to_pay_today = Decimal('0')
+                else:
+                    amount_to_pay, amount_to_pay_today = amounts[invoice_id]
+                amount = amount_to_pay_today or amount_to_pay
+                balance = {
+                    'invoice': invoice_id,
+                    'number': number,
+                    'party': party_id,
+                    'amount_to_pay': amount_to_pay,
+                    'amount_to_pay_today': amount_to_pay_today,
+                    'amount': abs(amount),
+                    'transaction_type': 'charge' if amount >= 0 else 'refund',
+                    'currency_digits': digits,
+                    'offset': invoice_id in offset_ids,
+                }
+                cls._payment_balances_cache.set(invoice_id, (now, balance))
+                balances[invoice_id] = balance
+
+        profiles = PaymentProfile.get_routable_profiles(
+            set(b['party'] for b in balances.values())
+        )
+        result = []
+        for record in invoices:
+            balance = dict(balances[record.id])
+            balance['payment_profiles'] = [{
+                'id': p.id,
+                'gateway': p.gateway.id,
+                'last_4_digits': p.last_4_digits,
+                'expiry_month': p.expiry_month,
+                'expiry_year': p.expiry_year,
+            } for p in profiles[balance['party']]]
+            result.append(balance)
+        return result
+
+    @classmethod
+    def get_party_payment_balances(cls, party_ids):
+        """
+        Return the payment balances of the posted customer invoices of the
+        parties, see `get_payment_balances`.
+
+        :param party_ids: List of party ids
+        """
+        return cls.get_payment_balances(cls.search([
+            ('party', 'in', party_ids),
+            ('type', '=', 'out'),
+            ('state', '=', 'posted'),
+        ], order=[('invoice_date', 'ASC'), ('id', 'ASC')]))
+
+    @classmethod
+    def get_unusable_payment_profiles(cls, invoices):
+        """
+        Report the parties of the invoices which can not be charged because
+        they have no usable payment profile, for customer outreach.
+
+        :param invoices: List of active records of invoices
+        :return: List of dictionaries with the party id and name, the latest
+                 payment profile id, the reason and the invoice ids
+        """
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        invoice_ids = {}
+        for invoice in invoices:
+            invoice_ids.setdefault(invoice.party, []).append(invoice.id)
+        _, unusable = PaymentProfile.get_charge_profiles(
+            [p.id for p in invoice_ids]
+        )
+        return [{
+            'party': party.id,
+            'party_name': party.rec_name,
+            'payment_profile': unusable[party.id][0].id
+            if unusable[party.id][0] else None,
+            'reason': unusable[party.id][1],
+            'invoices': invoice_ids[party],
+        } for party in sorted(invoice_ids, key=lambda p: p.id)
+            if party.id in unusable]
+
+    @classmethod
+    def export_gateway_payments(cls, from_date, to_date):
+        """
+        Export to a CSV file the invoices paid by gateway transactions
+        between two dates, for the auditors. The file is attached to the
+        company of the context.
+
+        The rows are read from the database by batches and written to a
+        temporary file as they come, which is then copied by chunks to the
+        attachment, so that the memory used does not grow with the number
+        of payments exported.
+
+        :param from_date: First date of the transactions
+        :param to_date: Last date of the transactions
+        :return: Id of the attachment
+        """
+        company_id = Transaction().context.get('company')
+        if not company_id:
+            cls.raise_user_error(
+                'The payments can only be exported for a company'
+            )
+        with tempfile.TemporaryFile() as export_file:
+            writer = csv.writer(export_file)
+            writer.writerow([
+                'invoice', 'number', 'party', 'transaction', 'uuid',
+                'provider_reference', 'type', 'gateway', 'date', 'currency',
+                'amount', 'state', 'reconciliation',
+            ])
+            for row in cls._get_gateway_payments(from_date, to_date):
+                writer.writerow([
+                    row['invoice'], (row['number'] or '').encode('utf-8'),
+                    row['party'], row['transaction'], row['uuid'],
+                    (row['provider_reference'] or '').encode('utf-8'),
+                    row['type'], (row['gateway_name'] or '').encode('utf-8'),
+                    row['date'], row['currency_code'], row['amount'],
+                    row['state'], row['reconciliation'],
+                ])
+            now = datetime.datetime.now()
+            return cls._attach_file(
+                export_file, 'gateway-payments-%s-%s-%s.csv' % (
+                    from_date.strftime('%Y%m%d'), to_date.strftime('%Y%m%d'),
+                    now.strftime('%Y%m%d%H%M%S%f')),
+                'company.company,%s' % company_id
+            )
+
+    @classmethod
+    def _attach_file(cls, file_, name, resource):
+        """
+        Create an attachment of the resource with the content of the file.
+
+        When the attachments are kept in the default filestore, the file is
+        copied into it by chunks so that its content is never loaded in
+        memory at once. Other filestores receive the whole content.
+
+        :param file_: File object opened for reading
+        :param name: Name of the attachment
+        :param resource: Reference of the record
+        :return: Id of the attachment
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+
+        values = {
+            'name': name,
+            'resource': resource,
+            'type': 'data',
+        }
+        field = Attachment._fields['data']
+        file_id = getattr(field, 'file_id', None)
+        file_.seek(0)
+        if file_id and type(filestore).__module__ == 'trytond.filestore':
+            values[file_id] = _store_file(
+                file_, field.store_prefix or Transaction().database.name
+            )
+        else:
+            values['data'] = file_.read()
+        with Transaction().set_user(0):
+            attachment, = Attachment.create([values])
+        return attachment.id
+
+    @classmethod
+    def _get_gateway_payments(cls, from_date, to_date, size=1000):
+        """
+        Yield a row for each completed or posted transaction originating
+        from an invoice of the company between the dates, with its payment
+        line on the account of the invoice and whether it is reconciled.
+
+        On PostgreSQL the query runs in a named cursor so that the result is
+        kept on the server and fetched `size` rows at a time.
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        Gateway = pool.get('payment_gateway.gateway')
+        Currency = pool.get('currency.currency')
+        MoveLine = pool.get('account.move.line')
+        invoice = cls.__table__()
+        transaction = PaymentTransaction.__table__()
+        gateway = Gateway.__table__()
+        currency = Currency.__table__()
+        line = MoveLine.__table__()
+
+        where = (
+            transaction.state.in_(['completed', 'posted'])
+            & transaction.origin.like(cls.__name__ + ',%')
+            & (transaction.date >= from_date)
+            & (transaction.date <= to_date)
+        )
+        company_id = Transaction().context.get('company')
+        if company_id:
+            where &= invoice.company == company_id
+        query = transaction.join(
+            invoice, condition=invoice.id == Cast(
+                Substring(
+                    transaction.origin,
+                    Position(',', transaction.origin) + Literal(1)
+                ), cls.id.sql_type().base)
+        ).join(
+            gateway, condition=gateway.id == transaction.gateway
+        ).join(
+            currency, condition=currency.id == transaction.currency
+        ).join(
+            line, 'LEFT', condition=(line.move == transaction.move)
+            & (line.account == invoice.account)
+        ).select(
+            invoice.id, invoice.number, invoice.party, transaction.id,
+            transaction.uuid, transaction.provider_reference,
+            transaction.type, gateway.name, transaction.date, currency.code,
+            transaction.amount, transaction.state, line.id,
+            line.reconciliation,
+            where=where,
+            order_by=[transaction.date, transaction.id]
+        )
+
+        connection = Transaction().connection
+        if backend.name() == 'postgresql':
+            cursor = connection.cursor('export_gateway_payments')
+        else:
+            cursor = connection.cursor()
+        try:
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                for row in rows:
+                    if row[12] is None:
+                        reconciliation = 'not_posted'
+                    elif row[13] is None:
+                        reconciliation = 'unreconciled'
+                    else:
+                        reconciliation = 'reconciled'
+                    yield {
+                        'invoice': row[0],
+                        'number': row[1],
+                        'party': row[2],
+                        'transaction': row[3],
+                        'uuid': row[4],
+                        'provider_reference': row[5],
+                        'type': row[6],
+                        'gateway_name': row[7],
+                        'date': row[8],
+                        'currency_code': row[9],
+                        'amount': Decimal(str(row[10])),
+                        'state': row[11],
+                        'reconciliation': reconciliation,
+                    }
+        finally:
+            cursor.close()
+
+    @classmethod
+    def _get_charge_plan(cls, invoice_ids):
+        """
+        Yield the charge planned by `batch_capture_and_pay` for each
+        invoice, computed with set based queries chunk by chunk.
+
+        Each row is a dictionary with the invoice id and number, the party
+        id, the currency code and the amount to charge, in the settlement
+        currency of the gateway when it has one, the payment profile and
+        gateway ids, the gateway name and the status: charge or the reason
+        why the invoice is skipped (not_posted, offset, below_threshold or
+        the reason of `party.payment_profile.get_charge_profiles`, or
+        no_gateway_available when gateway routing finds none).
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        PaymentProfile = pool.get('party.payment_profile')
+        AccountConfiguration = pool.get('account.configuration')
+        invoice = cls.__table__()
+        currency = Currency.__table__()
+        cursor = Transaction().connection.cursor()
+
         config = AccountConfiguration(1)
+        rates = RateTable()
+
+        for sub_ids in grouped_slice(invoice_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*invoice.join(
+                currency, condition=currency.id == invoice.currency
+            ).select(
+                invoice.id, invoice.number, invoice.party, invoice.type,
+                invoice.state, currency.code,
+                where=reduce_ids(invoice.id, sub_ids), order_by=invoice.id
+            ))
+            invoices = cursor.fetchall()
+
+            due = dict(
+                (i, today) for i, (_, today) in
+                cls._get_amounts_to_pay(sub_ids).items()
+            )
+            records = dict((i.id, i) for i in cls.browse(sub_ids))
+            offset_ids = cls.get_offset_invoice_ids(records.values())
+            party_ids = set(i[2] for i in invoices)
+            profiles, unusable = PaymentProfile.get_charge_profiles(
+                party_ids
+            )
+            if config.gateway_routing:
+                # The profiles batch_capture_and_pay routes to
+                profiles = cls._get_batch_payment_profiles(party_ids)
+
+            for invoice_id, number, party, type_, state, code in invoices:
+                profile = profiles.get(party)
+                amount = due[invoice_id]
+                if profile:
+                    # Charged in the settlement currency of the gateway
+                    currency_, amount = records[invoice_id].get_charge_amount(
+                        profile.gateway, amount, rates
+                    )
+                    code = currency_.code
+                row = {
+                    'invoice': invoice_id,
+                    'number': number,
+                    'party': party,
+                    'currency_code': code,
+                    'amount': amount,
+                    'payment_profile': profile.id if profile else None,
+                    'gateway': profile.gateway.id if profile else None,
+                    'gateway_name': profile.gateway.name if profile else None,
+                }
+                if type_ != 'out' or state != 'posted':
+                    row['status'] = 'not_posted'
+                elif invoice_id in offset_ids:
+                    row['status'] = 'offset'
+                elif due[invoice_id] <= config.write_off_threshold:
+                    row['status'] = 'below_threshold'
+                elif not profile:
+                    row['status'] = (
+                        unusable[party][1] if party in unusable
+                        else 'no_gateway_available')
+                else:
+                    row['status'] = 'charge'
+                yield row
+
+    @classmethod
+    def _get_amounts_to_pay(cls, invoice_ids):
+        """
+        Return the amount to pay and the amount to pay today of each
+        invoice, like the fields of the same name, with two queries.
+
+        Like the fields, the lines in the currency of the invoice count for
+        their second currency amount, and the other lines are converted
+        from the currency of the company at the currency date of the
+        invoice.
+
+        :param invoice_ids: List of invoice ids, at most the size of a
+                            slice of `grouped_slice`
+        :return: Dictionary mapping invoice ids to a tuple of the amount to
+                 pay and the amount to pay today
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Company = pool.get('company.company')
+        Currency = pool.get('currency.currency')
+        MoveLine = pool.get('account.move.line')
+        InvoicePaymentLine = pool.get('account.invoice-account.move.line')
+        invoice = cls.__table__()
+        company = Company.__table__()
+        line = MoveLine.__table__()
+        payment_line = InvoicePaymentLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        today = Date.today()
+        where = reduce_ids(invoice.id, invoice_ids)
+        in_currency = line.second_currency == invoice.currency
+        # Amounts in the currency of the invoice and in the one of the
+        # company, to convert
+        amount_currency = Case(
+            (in_currency, Coalesce(line.amount_second_currency, 0)),
+            else_=0
+        )
+        amount = Case((in_currency, 0), else_=line.debit - line.credit)
+        due = (line.maturity_date == Null) | (line.maturity_date <= today)
+        invoice_company = invoice.join(
+            company, condition=company.id == invoice.company
+        )
+        columns = [
+            invoice.id, invoice.currency, company.currency,
+            Coalesce(invoice.accounting_date, invoice.invoice_date),
+        ]
+
+        # Amount to pay and to pay today in each currency
+        amounts = {}
+        cursor.execute(*invoice_company.join(
+            line, condition=(line.move == invoice.move)
+            & (line.account == invoice.account)
+            & (line.reconciliation == Null)
+        ).select(
+            *(columns + [
+                Sum(amount_currency), Sum(amount),
+                Sum(Case((due, amount_currency), else_=0)),
+                Sum(Case((due, amount), else_=0)),
+            ]),
+            where=where, group_by=columns
+        ))
+        for row in cursor.fetchall():
+            amounts[row[0]] = [
+                row[1:4], [Decimal(str(v or 0)) for v in row[4:]]
+            ]
+        cursor.execute(*invoice_company.join(
+            payment_line, condition=payment_line.invoice == invoice.id
+        ).join(
+            line, condition=(line.id == payment_line.line)
+            & (line.reconciliation == Null)
+        ).select(
+            *(columns + [Sum(amount_currency), Sum(amount)]),
+            where=where, group_by=columns
+        ))
+        for row in cursor.fetchall():
+            values = amounts.setdefault(row[0], [row[1:4], [Decimal('0')] * 4])
+            value_currency, value = [Decimal(str(v or 0)) for v in row[4:]]
+            for index in (0, 2):
+                values[1][index] += value_currency
+                values[1][index + 1] += value
+
+        result = dict(
+            (i, (Decimal('0'), Decimal('0'))) for i in invoice_ids
+        )
+        rates = RateTable()
+        for invoice_id, (currencies, values) in amounts.items():
+            currency_id, company_currency_id, date = currencies
+            currency = Currency(currency_id)
+            company_currency = Currency(company_currency_id)
+            result[invoice_id] = tuple(
+                value_currency + rates.compute(
+                    company_currency, value, currency, date or today)
+                if value else value_currency
+                for value_currency, value in (values[:2], values[2:])
+            )
+        return result
+
+    @classmethod
+    def lock_for_payment(cls, invoices, skip_locked=False):
+        """
+        Lock the rows of the invoices until the end of the transaction, so
+        that concurrent payments of an invoice can not both add payment lines
+        while payments of other invoices are not serialized.
+
+        The lock never waits: an invoice being paid by another transaction
+        raises an error, or is left out of the result with `skip_locked`.
+        Batch workers use the latter to pay other invoices meanwhile. Other
+        database errors, like serialization failures, are raised as is so
+        that the request is retried.
+
+        :param invoices: List of active records of invoices
+        :param skip_locked: Skip the invoices locked by other transactions
+        :return: List of the locked invoices
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        if backend.name() != 'postgresql' or not invoices:
+            # Other backends lock the whole database on write
+            return invoices
+
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        if skip_locked:
+            lock = ' FOR UPDATE SKIP LOCKED'
+        else:
+            lock = ' FOR UPDATE NOWAIT'
+
+        locked_ids = set()
+        for sub_ids in grouped_slice([i.id for i in invoices]):
+            query, params = table.select(
+                table.id, where=reduce_ids(table.id, sub_ids)
+            )
+            try:
+                cursor.execute(query + lock, params)
+            except DatabaseOperationalError as exception:
+                if skip_locked or not cls._is_lock_not_available(exception):
+                    raise
+                cls.raise_user_error(
+                    'The invoice is being paid by another user, '
+                    'try again later'
+                )
+            locked_ids.update(row[0] for row in cursor.fetchall())
+        return [i for i in invoices if i.id in locked_ids]
+
+    @staticmethod
+    def _is_lock_not_available(exception):
+        "Tell whether the database error is a row locked by another user"
+        return getattr(exception, 'pgcode', None) == LOCK_NOT_AVAILABLE
+
+    @classmethod
+    def get_offset_invoice_ids(cls, invoices):
+        """
+        Return the ids of the invoices whose lines to pay are payment lines
+        of another invoice, i.e. invoices which were netted against another
+        one and are settled when that one is.
+
+        :param invoices: List of active records of invoices
+        :return: Set of invoice ids
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        InvoicePaymentLine = pool.get('account.invoice-account.move.line')
+        invoice = cls.__table__()
+        line = MoveLine.__table__()
+        payment_line = InvoicePaymentLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        query = Join(
+            Join(invoice, line, condition=(
+                (line.move == invoice.move)
+                & (line.account == invoice.account)
+            )),
+            payment_line, condition=(
+                (payment_line.line == line.id)
+                & (payment_line.invoice != invoice.id)
+            )
+        )
+        offset_ids = set()
+        for sub_ids in grouped_slice([i.id for i in invoices]):
+            cursor.execute(*query.select(
+                invoice.id, where=reduce_ids(invoice.id, sub_ids)
+            ))
+            offset_ids.update(row[0] for row in cursor.fetchall())
+        return offset_ids
+
+    @classmethod
+    def check_not_offset(cls, invoices):
+        """
+        Refuse to charge, refund or pay the invoices netted against another
+        invoice, which are settled when that one is
+        """
+        offset_ids = cls.get_offset_invoice_ids(invoices)
+        for invoice in invoices:
+            if invoice.id in offset_ids:
+                cls.raise_user_error(
+                    'The invoice "%s" was netted against another invoice '
+                    'and is settled with it' % invoice.rec_name
+                )
+
+    @classmethod
+    @buffer_payment_events
+    def net_credit_notes(cls, invoices):
+        """
+        Offset the open credit notes of the parties of the invoices against
+        their open invoices, per party, currency and receivable account.
+
+        The lines to pay of the smaller side are added to the payment lines
+        of the larger one, which is then only charged or refunded for the
+        net amount and reconciled with the netted lines once settled.
+
+        :param invoices: List of active records of invoices
+        """
+        party_ids = list(set(i.party.id for i in invoices if i.type == 'out'))
+        if not party_ids:
+            return
+
+        candidates = cls.search([
+            ('party', 'in', party_ids),
+            ('type', '=', 'out'),
+            ('state', '=', 'posted'),
+        ], order=[('invoice_date', 'ASC'), ('id', 'ASC')])
+        candidates = cls.lock_for_payment(candidates, skip_locked=True)
+        offset_ids = cls.get_offset_invoice_ids(candidates)
+        candidates = [
+            i for i in candidates
+            if i.id not in offset_ids and i.amount_to_pay
+        ]
+
+        def key(invoice):
+            return (invoice.party.id, invoice.currency.id, invoice.account.id)
+
+        to_add = {}
+        for _, group in groupby(sorted(candidates, key=key), key=key):
+            group = list(group)
+            debits = [i for i in group if i.amount_to_pay > 0]
+            credits = [i for i in group if i.amount_to_pay < 0]
+            if not debits or not credits:
+                continue
+            # Credit notes are netted into invoices, and what is left of
+            # the invoices into the remaining credit notes.
+            netted = cls._net_invoices(credits, debits)
+            used = set(i.id for i in netted)
+            used.update(i.id for s in netted.values() for i in s)
+            netted.update(cls._net_invoices(
+                [i for i in debits if i.id not in used],
+                [i for i in credits if i.id not in used]
+            ))
+            to_add.update(netted)
+
+        for target, sources in to_add.items():
+            cls.write([target], {
+                'payment_lines': [('add', [
+                    l.id for s in sources for l in s.lines_to_pay
+                    if not l.reconciliation
+                ])],
+            })
+            target.reconcile_installments()
+        if to_add:
+            cls._payment_balances_cache.clear()
+
+    @classmethod
+    def _net_invoices(cls, sources, targets):
+        """
+        Assign whole source invoices to the target invoices they fit in
+
+        Only invoices without payment lines are used as sources, as their
+        amount to pay is the sum of their lines to pay.
+
+        :return: Dictionary mapping target invoices to their sources
+        """
+        remaining = dict((t, abs(t.amount_to_pay)) for t in targets)
+        result = {}
+        for source in sources:
+            if source.payment_lines:
+                continue
+            amount = abs(source.amount_to_pay)
+            for target in targets:
+                if remaining[target] >= amount:
+                    remaining[target] -= amount
+                    result.setdefault(target, []).append(source)
+                    break
+        return result
+
+    @profile_payment
+    def pay_using_transaction(self, payment_transaction):
+        """
+        Pay an invoice using an existing payment_transaction. The invoice
+        is locked first, so that it is not paid twice concurrently.
+
+        :param payment_transaction: Active record of a payment transaction
+        """
+        PaymentEvent = Pool().get('account.invoice.payment_event')
+
+        self.lock_for_payment([self])
         for line in payment_transaction.move.lines:
             if line.reconciliation:
                 continue
@@ -89,20 +1356,112 @@ class Invoice:
                 self.write(
                     [self], {'payment_lines': [('add', [line.id])]}
                 )
-                if abs(self.amount_to_pay) <= config.write_off_threshold:
-                    # Reconcile lines to pay and payment lines from transaction
-                    try:
-                        AccountMoveLine.reconcile(
-                            self.lines_to_pay + self.payment_lines,
-                            journal=config.write_off_journal,
-                            date=Date.today()
-                        )
-                    except UserError:
-                        # If reconcilation fails, do not raise the error
-                        pass
+                self._payment_balances_cache.clear()
+                PaymentEvent.record(
+                    'paid', invoice=self, transaction=payment_transaction,
+                    amount=payment_transaction.amount
+                )
+                self.reconcile_installments()
                 return line
         raise Exception('Missing account')
 
+    def reverse_payment_using_transaction(self, refund_transaction):
+        """
+        Reverse a payment of the invoice taken back by a chargeback: the
+        lines of the invoice are unreconciled and the refund transaction of
+        the charge is added to the payment lines, so that its amount is due
+        again.
+
+        :param refund_transaction: Active record of a posted refund
+                                   transaction
+        """
+        pool = Pool()
+        Reconciliation = pool.get('account.move.reconciliation')
+        PaymentEvent = pool.get('account.invoice.payment_event')
+
+        reconciliations = set(
+            l.reconciliation
+            for l in list(self.lines_to_pay) + list(self.payment_lines)
+            if l.reconciliation
+        )
+        if reconciliations:
+            Reconciliation.delete(list(reconciliations))
+
+        for line in refund_transaction.move.lines:
+            if line.reconciliation or line.account != self.account:
+                continue
+            self.write([self], {'payment_lines': [('add', [line.id])]})
+            self._payment_balances_cache.clear()
+            PaymentEvent.record(
+                'chargeback', invoice=self, transaction=refund_transaction,
+                amount=refund_transaction.amount
+            )
+            self.reconcile_installments()
+            return line
+        raise Exception('Missing account')
+
+    def reconcile_installments(self):
+        """
+        Reconcile the payment lines not reconciled yet with the lines to pay
+        they cover, earliest maturity first.
+
+        Only unreconciled lines are processed, so the work done for each
+        payment stays the same whatever the number of earlier payments.
+        Once the whole invoice is paid within the write-off threshold, the
+        remaining lines are reconciled with a write-off.
+        """
+        Date = Pool().get('ir.date')
+        AccountMoveLine = Pool().get('account.move.line')
+        PaymentEvent = Pool().get('account.invoice.payment_event')
+        AccountConfiguration = Pool().get('account.configuration')
+
+        config = AccountConfiguration(1)
+        lines_to_pay = sorted(
+            [l for l in self.lines_to_pay if not l.reconciliation],
+            key=lambda l: (l.maturity_date or datetime.date.max, l.id)
+        )
+        payment_lines = [l for l in self.payment_lines if not l.reconciliation]
+        if not lines_to_pay or not payment_lines:
+            return
+
+        if abs(self.amount_to_pay) <= config.write_off_threshold:
+            # Reconcile lines to pay and payment lines from transaction
+            lines = lines_to_pay + payment_lines
+            journal = config.write_off_journal
+        else:
+            # Reconcile the installments which are exactly covered
+            paid = sum(l.debit - l.credit for l in payment_lines)
+            due = Decimal('0')
+            lines = []
+            for index, line in enumerate(lines_to_pay):
+                due += line.debit - line.credit
+                if due + paid == 0:
+                    lines = lines_to_pay[:index + 1] + payment_lines
+                    break
+                if abs(due) > abs(paid):
+                    break
+            journal = None
+        if not lines:
+            return
+
+        try:
+            AccountMoveLine.reconcile(
+                lines, journal=journal, date=Date.today()
+            )
+        except UserError as exception:
+            # If reconcilation fails, do not raise the error
+            PaymentEvent.record(
+                'write_off_skipped' if journal else 'failed', invoice=self,
+                message=unicode(exception)[:200]
+            )
+        else:
+            PaymentEvent.record(
+                'reconciled', invoice=self,
+                amount=sum(
+                    l.debit - l.credit for l in lines_to_pay if l in lines
+                )
+            )
+
     @classmethod
     @ModelView.button_action(
         'invoice_payment_gateway.wizard_pay_using_transaction')
@@ -179,9 +1538,10 @@ class PayInvoiceUsingTransactionStart(BaseCreditCardViewMixin, ModelView):
             ('party', '=', Eval('party')),
             ('gateway', '=', Eval('gateway')),
         ], states={
-            'required': Eval('transaction_type') == 'refund',
             'invisible': Eval('transaction_type') != 'refund'
-        }, depends=['party', 'transaction_type', 'gateway']
+        }, depends=['party', 'transaction_type', 'gateway'],
+        help='Leave empty to split the refund over the captured transactions '
+        'of the party, newest first.'
     )
 
     @classmethod
@@ -296,8 +1656,11 @@ class PayInvoiceUsingTransaction(Wizard):
 
     def default_start(self, field=None):
         Invoice = Pool().get('account.invoice')
+        Gateway = Pool().get('payment_gateway.gateway')
+        PaymentProfile = Pool().get('party.payment_profile')
 
         invoice = Invoice(Transaction().context.get('active_id'))
+        Invoice.check_not_offset([invoice])
 
         if (invoice.amount_to_pay_today or invoice.amount_to_pay) >= 0:
             transaction_type = 'charge'
@@ -315,6 +1678,28 @@ class PayInvoiceUsingTransaction(Wizard):
             'user': Transaction().user,
             'transaction_type': transaction_type,
         }
+
+        # Pre-fill the first gateway of the user on which the party has a
+        # payment profile, or the only gateway of the user
+        gateway_ids = Gateway.get_user_gateways(Transaction().user)
+        for gateway_id in gateway_ids:
+            profile_id = PaymentProfile.get_default_profile(
+                invoice.party.id, gateway_id
+            )
+            if profile_id:
+                res.update({
+                    'gateway': gateway_id,
+                    'method': Gateway(gateway_id).method,
+                    'use_existing_card': True,
+                    'payment_profile': profile_id,
+                })
+                break
+        else:
+            if len(gateway_ids) == 1:
+                res.update({
+                    'gateway': gateway_ids[0],
+                    'method': Gateway(gateway_ids[0]).method,
+                })
         return res
 
     def create_payment_transaction(self, profile=None):
@@ -324,6 +1709,9 @@ class PayInvoiceUsingTransaction(Wizard):
         PaymentTransaction = Pool().get('payment_gateway.transaction')
         Date = Pool().get('ir.date')
 
+        currency, amount = self.start.invoice.get_charge_amount(
+            self.start.gateway, abs(self.start.amount)
+        )
         return PaymentTransaction(
             origin='%s,%s' % (
                 self.start.invoice.__name__, self.start.invoice.id),
@@ -332,8 +1720,8 @@ class PayInvoiceUsingTransaction(Wizard):
             address=self.start.invoice.invoice_address,
             gateway=self.start.gateway,
             payment_profile=profile,
-            amount=abs(self.start.amount),
-            currency=self.start.invoice.currency,
+            amount=amount,
+            currency=currency,
             description=self.start.reference or None,
             date=Date.today(),
         )
@@ -342,35 +1730,30 @@ class PayInvoiceUsingTransaction(Wizard):
         """
         Helper function to create payment profile
         """
-        Invoice = Pool().get('account.invoice')
-        ProfileWizard = Pool().get(
-            'party.party.payment_profile.add', type="wizard"
-        )
-        profile_wizard = ProfileWizard(
-            ProfileWizard.create()[0]
+        PaymentProfile = Pool().get('party.payment_profile')
+
+        return PaymentProfile.create_from_card(
+            self.start.party, self.start.invoice.invoice_address,
+            self.start.gateway, {
+                'owner': self.start.owner,
+                'number': self.start.number,
+                'expiry_month': self.start.expiry_month,
+                'expiry_year': self.start.expiry_year,
+                'csc': self.start.csc or '',
+            }
         )
-        profile_wizard.card_info.owner = self.start.owner
-        profile_wizard.card_info.number = self.start.number
-        profile_wizard.card_info.expiry_month = self.start.expiry_month
-        profile_wizard.card_info.expiry_year = self.start.expiry_year
-        profile_wizard.card_info.csc = self.start.csc or ''
-        profile_wizard.card_info.gateway = self.start.gateway
-        profile_wizard.card_info.provider = self.start.gateway.provider
-        profile_wizard.card_info.address = Invoice(
-            Transaction().context.get('active_id')
-        ).invoice_address
-        profile_wizard.card_info.party = self.start.party
-
-        with Transaction().set_context(return_profile=True):
-            profile = profile_wizard.transition_add()
-        return profile
 
+    @profile_payment
+    @buffer_payment_events
     def transition_pay(self):
         """
         Creates a new payment transaction and pay invoice with it
         """
         PaymentTransaction = Pool().get('payment_gateway.transaction')
+        PaymentEvent = Pool().get('account.invoice.payment_event')
 
+        self.start.invoice.lock_for_payment([self.start.invoice])
+        self.start.invoice.check_not_offset([self.start.invoice])
         if self.start.transaction_type == 'charge':
             profile = self.start.payment_profile
             if self.start.method == 'credit_card' and (
@@ -382,7 +1765,7 @@ class PayInvoiceUsingTransaction(Wizard):
             transaction.save()
 
             # Capture Transaction
-            PaymentTransaction.capture([transaction])
+            PaymentTransaction.capture_and_monitor([transaction])
             if transaction.state in ('completed', 'posted'):
                 # Pay invoice using above captured transaction
                 self.start.invoice.pay_using_transaction(transaction)
@@ -392,13 +1775,30 @@ class PayInvoiceUsingTransaction(Wizard):
                 return 'failed'
 
         elif self.start.transaction_type == 'refund':
-            refund_transaction = self.start.transaction.create_refund(
-                self.start.amount
-            )
-            PaymentTransaction.refund([refund_transaction])
-            if refund_transaction.state in ('completed', 'posted'):
-                self.start.invoice.pay_using_transaction(refund_transaction)
+            if self.start.transaction:
+                refund_transactions = [
+                    self.start.transaction.create_refund(self.start.amount)
+                ]
             else:
+                refund_transactions = \
+                    self.start.invoice.create_refund_transactions(
+                        self.start.amount, gateway=self.start.gateway
+                    )
+            PaymentEvent.record_transactions('created', refund_transactions)
+            PaymentTransaction.refund(refund_transactions)
+            PaymentEvent.record_results(
+                'refunded', refund_transactions, 'refund'
+            )
+
+            failed = False
+            for refund_transaction in refund_transactions:
+                if refund_transaction.state in ('completed', 'posted'):
+                    self.start.invoice.pay_using_transaction(
+                        refund_transaction
+                    )
+                else:
+                    failed = True
+            if failed:
                 self.failed.message = \
                     "Payment refund failed, refer transaction logs"
                 return 'failed'
@@ -415,6 +1815,37 @@ class PaymentTransaction:
     'Gateway Transaction'
     __name__ = 'payment_gateway.transaction'
 
+    @classmethod
+    def __setup__(cls):
+        super(PaymentTransaction, cls).__setup__()
+        # Outcomes notified by the gateways
+        cls._transitions |= set((
+            ('draft', 'completed'),
+            ('draft', 'failed'),
+            ('draft', 'cancel'),
+            ('authorized', 'completed'),
+            ('authorized', 'failed'),
+            ('authorized', 'cancel'),
+        ))
+
+    @classmethod
+    @Workflow.transition('completed')
+    def complete_from_notification(cls, transactions):
+        "Complete the transactions settled by the gateway"
+        pass
+
+    @classmethod
+    @Workflow.transition('failed')
+    def fail_from_notification(cls, transactions):
+        "Fail the transactions declined by the gateway"
+        pass
+
+    @classmethod
+    @Workflow.transition('cancel')
+    def cancel_from_notification(cls, transactions):
+        "Cancel the transactions voided at the gateway"
+        pass
+
     @classmethod
     def _get_origin(cls):
         'Add invoice to the selections'
@@ -423,6 +1854,63 @@ class PaymentTransaction:
         res.append('account.invoice')
         return res
 
+    @classmethod
+    def capture_and_monitor(cls, transactions):
+        """
+        Capture the transactions gateway by gateway and record the latency
+        and the failures of each gateway for routing.
+
+        Only the captures raising an exception or slower than the timeout
+        of the routing are gateway errors: cards declined by a gateway do
+        not keep captures away from it.
+
+        :param transactions: List of active records of transactions
+        """
+        PaymentEvent = Pool().get('account.invoice.payment_event')
+
+        PaymentEvent.record_transactions('created', transactions)
+        by_gateway = {}
+        for transaction in transactions:
+            by_gateway.setdefault(transaction.gateway, []).append(transaction)
+
+        for gateway, gateway_transactions in by_gateway.items():
+            start = time.time()
+            try:
+                cls.capture(gateway_transactions)
+            except Exception:
+                gateway_health.record(gateway.id, time.time() - start, True)
+                raise
+            latency = (time.time() - start) / len(gateway_transactions)
+            for transaction in gateway_transactions:
+                gateway_health.record(gateway.id, latency, False)
+            PaymentEvent.record_results(
+                'captured', gateway_transactions, 'capture'
+            )
+
+    @classmethod
+    def settle_batch(cls, transactions):
+        """
+        Settle authorized transactions in bulk.
+
+        Transactions are grouped by gateway. A provider which offers a batch
+        capture endpoint can implement `settle_batch_<provider>` as a
+        classmethod receiving all the transactions of a gateway, otherwise
+        the transactions are settled one by one.
+
+        :param transactions: List of active records of authorized
+                             transactions
+        """
+        by_gateway = {}
+        for transaction in transactions:
+            by_gateway.setdefault(transaction.gateway, []).append(transaction)
+
+        for gateway, gateway_transactions in by_gateway.items():
+            method_name = 'settle_batch_%s' % gateway.provider
+            if hasattr(cls, method_name):
+                getattr(cls, method_name)(gateway_transactions)
+            else:
+                cls.settle(gateway_transactions)
+
 
 class AccountConfiguration:
     __name__ = 'account.configuration'
@@ -434,7 +1922,38 @@ class AccountConfiguration:
     write_off_threshold = fields.Numeric(
         'Writeoff Threshold', required=True
     )
+    gateway_routing = fields.Boolean(
+        'Gateway Routing',
+        help='Route captures to another payment profile of the party on a '
+        'healthy gateway when the gateway of the profile fails or slows down.'
+    )
+    authorize_on_post = fields.Boolean(
+        'Authorize on Post',
+        help='Authorize customer invoices against the payment profile of '
+        'the party when posted, and capture them later in bulk.'
+    )
+    authorization_validity = fields.Integer(
+        'Authorization Validity',
+        states={
+            'invisible': ~Eval('authorize_on_post'),
+        }, depends=['authorize_on_post'],
+        help='Number of days the gateways keep the authorizations. They are '
+        'renewed on their last day when the invoice is not due yet. Leave '
+        'empty when they do not expire.'
+    )
 
     @staticmethod
     def default_write_off_threshold():
         return Decimal('0')
+
+    @staticmethod
+    def default_authorize_on_post():
+        return False
+
+    @staticmethod
+    def default_authorization_validity():
+        return 7
+
+    @staticmethod
+    def default_gateway_routing():
+        return False
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+from decimal import Decimal
+
+from trytond.exceptions import UserError
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice
+
+from event import buffer_payment_events
+
+__all__ = ['PaymentNotification', 'NotificationSignatureError']
+
+# Transition of the transaction applied for each kind of notification
+NOTIFICATION_TRANSITIONS = {
+    'captured': 'complete_from_notification',
+    'refunded': 'complete_from_notification',
+    'failed': 'fail_from_notification',
+    'cancelled': 'cancel_from_notification',
+}
+# Settled charges taken back by the bank of the customer
+CHARGEBACK = 'chargeback'
+
+
+class NotificationSignatureError(UserError):
+    "The payload of a notification is not signed by the gateway"
+
+
+class PaymentNotification(ModelSQL, ModelView):
+    'Payment Notification'
+    __name__ = 'account.invoice.payment_notification'
+
+    event_id = fields.Char(
+        'Event ID', required=True, readonly=True, select=True
+    )
+    gateway = fields.Many2One(
+        'payment_gateway.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='RESTRICT'
+    )
+    event = fields.Char('Event', required=True, readonly=True)
+    provider_reference = fields.Char('Provider Reference', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 4), readonly=True)
+    transaction = fields.Many2One(
+        'payment_gateway.transaction', 'Transaction', readonly=True,
+        select=True, ondelete='RESTRICT'
+    )
+    received_date = fields.DateTime(
+        'Received Date', required=True, readonly=True
+    )
+    state = fields.Selection([
+        ('processed', 'Processed'),
+        ('ignored', 'Ignored'),
+    ], 'State', required=True, readonly=True, select=True)
+    message = fields.Char('Message', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentNotification, cls).__setup__()
+        cls._order.insert(0, ('received_date', 'DESC'))
+        cls._sql_constraints += [
+            ('event_id_uniq', 'UNIQUE(gateway, event_id)',
+                'The event of a gateway notification must be unique.'),
+        ]
+        cls.__rpc__.update({
+            'receive': RPC(readonly=False),
+        })
+
+    @classmethod
+    def receive(cls, gateway_id, payload, signature):
+        """
+        Verify the signature of a payload posted by a gateway and ingest
+        its notifications.
+
+        :param gateway_id: Id of the gateway posting the payload
+        :param payload: JSON list of notifications, or a single one, as
+                        received
+        :param signature: Signature of the payload sent by the gateway
+        :return: The statuses returned by `ingest`
+        :raise NotificationSignatureError: When the signature is not the
+                                           one of the gateway
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        gateway = Gateway(gateway_id)
+        if not gateway.verify_notification(payload, signature):
+            raise NotificationSignatureError(
+                'The notification is not signed by the gateway "%s"'
+                % gateway.rec_name
+            )
+        notifications = json.loads(payload, parse_float=Decimal)
+        if isinstance(notifications, dict):
+            notifications = [notifications]
+        for notification in notifications:
+            notification['gateway'] = gateway.id
+        return cls.ingest(notifications)
+
+    @classmethod
+    @buffer_payment_events
+    def ingest(cls, notifications):
+        """
+        Apply a batch of asynchronous notifications of the gateways to the
+        transactions, and pay the invoices of the newly settled ones.
+
+        Each notification is a dictionary with the `event_id` given by the
+        gateway, the `gateway` id, the `event` (captured, refunded, failed,
+        cancelled or chargeback), the `provider_reference` of the
+        transaction and optionally its `amount`. Notifications already
+        received are not applied again, so gateways can deliver them more
+        than once.
+
+        Only transactions still waiting for the gateway, in draft or
+        authorized state, are changed, except for chargebacks which apply
+        to settled charges: the amount taken back is recorded as a refund
+        of the charge and the payment of its invoice is reversed.
+        Notifications of other transactions are stored as ignored.
+
+        The notifications must come from the gateways: use `receive` for
+        the payloads posted to the server.
+
+        :param notifications: List of dictionaries
+        :return: List of dictionaries with the event id and the status
+                 (processed, ignored or duplicate), in the order of the
+                 notifications
+        """
+        results = [{
+            'event_id': n['event_id'],
+            'status': 'duplicate',
+        } for n in notifications]
+
+        new = cls._get_new_notifications(notifications)
+        transactions = cls._get_notified_transactions(
+            [notifications[i] for i in new]
+        )
+
+        now = datetime.datetime.now()
+        to_create, to_transition, chargebacks = [], {}, []
+        for index in new:
+            notification = notifications[index]
+            transaction = transactions.get((
+                notification['gateway'],
+                notification.get('provider_reference'),
+            ))
+            message = cls._check_notification(notification, transaction)
+            to_create.append(
+                cls._get_notification_values(
+                    notification, transaction, now, message
+                )
+            )
+            results[index]['status'] = 'ignored' if message else 'processed'
+            if message:
+                continue
+            if notification['event'] == CHARGEBACK:
+                chargebacks.append((transaction, notification.get('amount')))
+                continue
+            # A later notification of the batch supersedes an earlier one
+            for event_transactions in to_transition.values():
+                if transaction in event_transactions:
+                    event_transactions.remove(transaction)
+            to_transition.setdefault(
+                notification['event'], []
+            ).append(transaction)
+        cls.create(to_create)
+
+        cls._pay_settled(cls._apply_transitions(to_transition))
+        cls._charge_back(chargebacks)
+        return results
+
+    @classmethod
+    def _get_new_notifications(cls, notifications):
+        """
+        Return the indexes of the notifications not received before, nor
+        earlier in the batch
+        """
+        seen = set()
+        for sub_ids in grouped_slice(
+                list(set(n['event_id'] for n in notifications))):
+            seen.update(
+                (n.gateway.id, n.event_id) for n in cls.search([
+                    ('event_id', 'in', list(sub_ids)),
+                ])
+            )
+        new = []
+        for index, notification in enumerate(notifications):
+            key = (notification['gateway'], notification['event_id'])
+            if key not in seen:
+                seen.add(key)
+                new.append(index)
+        return new
+
+    @classmethod
+    def _get_notified_transactions(cls, notifications):
+        """
+        Return the transactions of the notifications by gateway id and
+        provider reference
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        transactions = {}
+        references = list(set(
+            n['provider_reference'] for n in notifications
+            if n.get('provider_reference')
+        ))
+        for sub_references in grouped_slice(references):
+            for transaction in PaymentTransaction.search([
+                    ('provider_reference', 'in', list(sub_references)),
+                    ]):
+                transactions[(
+                    transaction.gateway.id, transaction.provider_reference
+                )] = transaction
+        return transactions
+
+    @classmethod
+    def _get_notification_values(
+        cls, notification, transaction, received_date, message
+    ):
+        "Return the values to store the notification"
+        return {
+            'event_id': notification['event_id'],
+            'gateway': notification['gateway'],
+            'event': notification['event'],
+            'provider_reference': notification.get('provider_reference'),
+            'amount': notification.get('amount'),
+            'transaction': transaction.id if transaction else None,
+            'received_date': received_date,
+            'state': 'ignored' if message else 'processed',
+            'message': message,
+        }
+
+    @classmethod
+    def _apply_transitions(cls, to_transition):
+        """
+        Move the transactions through the transition of their event and
+        return the settled ones
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        PaymentEvent = pool.get('account.invoice.payment_event')
+
+        settled = []
+        for event, transactions in to_transition.items():
+            if not transactions:
+                continue
+            transition = NOTIFICATION_TRANSITIONS[event]
+            getattr(PaymentTransaction, transition)(transactions)
+            PaymentEvent.record_transactions(
+                event, transactions, message='notification'
+            )
+            if transition == 'complete_from_notification':
+                settled.extend(transactions)
+        return settled
+
+    @classmethod
+    def _pay_settled(cls, settled):
+        """
+        Post the settled transactions and pay their invoices.
+
+        The invoices are locked without waiting: an invoice being paid by
+        another worker fails the whole batch, which the gateway delivers
+        again later.
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        Invoice = pool.get('account.invoice')
+
+        if not settled:
+            return
+        PaymentTransaction.safe_post(settled)
+        settled = [t for t in settled if isinstance(t.origin, Invoice)]
+        Invoice.lock_for_payment(list(set(t.origin for t in settled)))
+        for transaction in settled:
+            transaction.origin.pay_using_transaction(transaction)
+
+    @classmethod
+    def _charge_back(cls, chargebacks):
+        """
+        Record the amounts taken back from the charges as refunds, which
+        the gateways already made, and reverse the payments of their
+        invoices.
+
+        :param chargebacks: List of tuples of the charge and the amount
+                            taken back, or None for all of it
+        """
+        pool = Pool()
+        PaymentTransaction = pool.get('payment_gateway.transaction')
+        PaymentEvent = pool.get('account.invoice.payment_event')
+        Invoice = pool.get('account.invoice')
+
+        if not chargebacks:
+            return
+        refunds = []
+        for charge, amount in chargebacks:
+            if amount is None:
+                amount = charge.amount_available_for_refund
+            refunds.append(charge.create_refund(Decimal(str(amount))))
+        PaymentEvent.record_transactions('created', refunds)
+        PaymentTransaction.complete_from_notification(refunds)
+        PaymentEvent.record_transactions(
+            'refunded', refunds, message=CHARGEBACK
+        )
+        PaymentTransaction.safe_post(refunds)
+
+        invoices = [
+            c.origin for c, _ in chargebacks if isinstance(c.origin, Invoice)
+        ]
+        Invoice.lock_for_payment(list(set(invoices)))
+        for (charge, _), refund in zip(chargebacks, refunds):
+            if isinstance(charge.origin, Invoice):
+                charge.origin.reverse_payment_using_transaction(refund)
+
+    @classmethod
+    def _check_notification(cls, notification, transaction):
+        """
+        Return why the notification can not be applied to the transaction,
+        or None
+        """
+        event = notification['event']
+        if event not in NOTIFICATION_TRANSITIONS and event != CHARGEBACK:
+            return 'unknown_event'
+        if transaction is None:
+            return 'unknown_transaction'
+        if event == CHARGEBACK:
+            return cls._check_chargeback(notification, transaction)
+        if transaction.state not in ('draft', 'authorized'):
+            return 'transaction_%s' % transaction.state
+        if (notification['event'] == 'refunded') != (
+                transaction.type == 'refund'):
+            return 'type_mismatch'
+        if (notification.get('amount') is not None
+                and Decimal(str(notification['amount']))
+                != transaction.amount):
+            return 'amount_mismatch'
+        return None
+
+    @classmethod
+    def _check_chargeback(cls, notification, transaction):
+        """
+        Return why the chargeback can not be applied to the transaction, or
+        None
+        """
+        if transaction.type != 'charge':
+            return 'type_mismatch'
+        if transaction.state not in ('completed', 'posted'):
+            return 'transaction_%s' % transaction.state
+        if (notification.get('amount') is not None
+                and Decimal(str(notification['amount']))
+                > transaction.amount_available_for_refund):
+            return 'amount_mismatch'
+        return None
@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+from threading import Thread
+from uuid import uuid4
+from Queue import Queue, Empty
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import fields
+from trytond.pool import PoolMeta, Pool
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentProfile']
+__metaclass__ = PoolMeta
+
+
+class PaymentProfile:
+    __name__ = 'party.payment_profile'
+
+    onboarding_reference = fields.Char(
+        'Onboarding Reference', readonly=True, select=True
+    )
+    _default_profile_cache = Cache(
+        'party.payment_profile.default_profile', context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentProfile, cls).__setup__()
+        cls._sql_constraints += [
+            ('onboarding_reference_uniq', 'UNIQUE(onboarding_reference)',
+                'The onboarding reference of the payment profile must be '
+                'unique.'),
+        ]
+        cls.__rpc__.update({
+            'onboard_cards': RPC(readonly=False),
+        })
+
+    @classmethod
+    def create(cls, vlist):
+        profiles = super(PaymentProfile, cls).create(vlist)
+        cls._default_profile_cache.clear()
+        return profiles
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentProfile, cls).write(*args)
+        cls._default_profile_cache.clear()
+
+    @classmethod
+    def delete(cls, profiles):
+        super(PaymentProfile, cls).delete(profiles)
+        cls._default_profile_cache.clear()
+
+    @classmethod
+    def get_default_profile(cls, party_id, gateway_id):
+        """
+        Return the id of the payment profile charged by default for the
+        party on the gateway, or None. The result is cached until a profile
+        or a gateway is modified.
+        """
+        Date = Pool().get('ir.date')
+
+        key = (party_id, gateway_id, Date.today())
+        profile_id = cls._default_profile_cache.get(key, -1)
+        if profile_id == -1:
+            profiles, _ = cls.get_charge_profiles(
+                [party_id], gateway=gateway_id
+            )
+            profile = profiles.get(party_id)
+            profile_id = profile.id if profile else None
+            cls._default_profile_cache.set(key, profile_id)
+        return profile_id
+
+    @classmethod
+    def get_charge_profiles(cls, party_ids, gateway=None):
+        """
+        Return the payment profile to charge for each party, and why the
+        other parties can not be charged.
+
+        All the profiles of the parties, inactive ones included, are scanned
+        with a single search. The latest usable profile of a party is
+        charged. When a party has none, the reason reported is the one of
+        its latest profile: inactive_profile, inactive_gateway,
+        gateway_mismatch or expired_card, or no_profile.
+
+        :param party_ids: List of party ids
+        :param gateway: Only charge profiles of this gateway (optional)
+        :return: Tuple of a dictionary mapping party ids to profiles and a
+                 dictionary mapping party ids to a tuple of the latest
+                 unusable profile (or None) and the reason
+        """
+        Date = Pool().get('ir.date')
+
+        today = Date.today()
+        with Transaction().set_context(active_test=False):
+            profiles = cls.search([
+                ('party', 'in', list(party_ids)),
+            ], order=[('id', 'DESC')])
+
+        usable, unusable = {}, {}
+        for profile in profiles:
+            party_id = profile.party.id
+            if party_id in usable:
+                continue
+            reason = profile.get_unusable_reason(today, gateway)
+            if reason is None:
+                usable[party_id] = profile
+                unusable.pop(party_id, None)
+            else:
+                unusable.setdefault(party_id, (profile, reason))
+        for party_id in party_ids:
+            if party_id not in usable:
+                unusable.setdefault(party_id, (None, 'no_profile'))
+        return usable, unusable
+
+    @classmethod
+    def get_routable_profiles(cls, party_ids):
+        """
+        Return all the usable payment profiles of each party, newest first,
+        among which captures can be routed to a healthy gateway.
+
+        :param party_ids: List of party ids
+        :return: Dictionary mapping party ids to lists of profiles
+        """
+        Date = Pool().get('ir.date')
+
+        today = Date.today()
+        result = dict((party_id, []) for party_id in party_ids)
+        for profile in cls.search([
+                ('party', 'in', list(party_ids)),
+                ], order=[('id', 'DESC')]):
+            if profile.get_unusable_reason(today) is None:
+                result[profile.party.id].append(profile)
+        return result
+
+    def get_unusable_reason(self, date, gateway=None):
+        """
+        Return why the profile can not be charged at the date, or None
+
+        :param date: Date of the charge
+        :param gateway: Gateway the charge must go through (optional)
+        """
+        if not self.active:
+            return 'inactive_profile'
+        if not self.gateway.active:
+            return 'inactive_gateway'
+        if gateway is not None and self.gateway.id != int(gateway):
+            return 'gateway_mismatch'
+        if self.expiry_year and self.expiry_month and (
+                int(self.expiry_year), int(self.expiry_month)) < (
+                date.year, date.month):
+            return 'expired_card'
+        return None
+
+    @classmethod
+    def create_from_card(cls, party, address, gateway, card):
+        """
+        Tokenize the card with the gateway and create the payment profile
+        in one step, without going through the add payment profile wizard.
+
+        A provider supports direct tokenization by implementing
+        `tokenize_card_<provider>` as a classmethod which receives the
+        gateway and the card and returns the provider reference. Providers
+        which do not are handled by the add payment profile wizard.
+
+        :param party: Active record of the party
+        :param address: Active record of the address of the card
+        :param gateway: Active record of the payment gateway
+        :param card: Dictionary with owner, number, expiry_month,
+                     expiry_year and csc of the card
+        :return: Active record of the created profile
+        """
+        method_name = 'tokenize_card_%s' % gateway.provider
+        if not hasattr(cls, method_name):
+            return cls._create_from_card_using_wizard(
+                party, address, gateway, card
+            )
+
+        provider_reference = getattr(cls, method_name)(gateway, card)
+        profile = cls._get_profile_from_card(
+            party, address, gateway, card, provider_reference
+        )
+        profile.save()
+        return profile
+
+    @classmethod
+    def _get_profile_from_card(
+            cls, party, address, gateway, card, provider_reference):
+        """
+        Return an unsaved payment profile for a tokenized card
+        """
+        return cls(
+            party=party,
+            address=address,
+            gateway=gateway,
+            last_4_digits=card['number'][-4:],
+            expiry_month=card['expiry_month'],
+            expiry_year=card['expiry_year'],
+            provider_reference=provider_reference,
+        )
+
+    @classmethod
+    def _create_from_card_using_wizard(cls, party, address, gateway, card):
+        """
+        Create the payment profile through the add payment profile wizard,
+        for providers which only implement the tokenization there.
+        """
+        ProfileWizard = Pool().get(
+            'party.party.payment_profile.add', type="wizard"
+        )
+        profile_wizard = ProfileWizard(
+            ProfileWizard.create()[0]
+        )
+        profile_wizard.card_info.owner = card['owner']
+        profile_wizard.card_info.number = card['number']
+        profile_wizard.card_info.expiry_month = card['expiry_month']
+        profile_wizard.card_info.expiry_year = card['expiry_year']
+        profile_wizard.card_info.csc = card.get('csc') or ''
+        profile_wizard.card_info.gateway = gateway
+        profile_wizard.card_info.provider = gateway.provider
+        profile_wizard.card_info.address = address
+        profile_wizard.card_info.party = party
+
+        with Transaction().set_context(return_profile=True):
+            profile = profile_wizard.transition_add()
+        return profile
+
+    @classmethod
+    def tokenize_card_dummy(cls, gateway, card):
+        """
+        Dummy provider
+        """
+        return str(uuid4())
+
+    @classmethod
+    def onboard_cards(cls, rows, workers=None):
+        """
+        Create payment profiles in bulk, typically when migrating customers
+        from another billing system.
+
+        Each row is a dictionary with a unique `reference`, the `party` id,
+        the `gateway` id and optionally the `address` id (defaults to the
+        invoice address of the party). A row carries either the card
+        (owner, number, expiry_month, expiry_year and csc) which gets
+        tokenized, or an existing `provider_reference` with
+        `last_4_digits`, `expiry_month` and `expiry_year`.
+
+        The rows are onboarded by chunks of `onboarding_chunk_size`, and
+        each chunk is committed once its profiles are created, so that a
+        crash loses at most the tokens of one chunk. Within a chunk, cards
+        are tokenized concurrently by at most `workers` threads, each using
+        its own transaction.
+
+        Rows whose reference was already onboarded are not processed again,
+        so a run interrupted by a crash can be resumed by sending the same
+        rows again. Rows repeating a reference of the batch get the result
+        of its first row. Rows with an unknown party or gateway, or without
+        the values they need, fail before any card is tokenized, and rows
+        whose profile can not be created fail alone.
+
+        :param rows: List of dictionaries
+        :param workers: Maximum number of concurrent tokenization requests
+        :return: List of dictionaries with the reference, the status
+                 (created, exists or failed), the profile id and an error
+                 message, in the order of the rows
+        """
+        if workers is None:
+            workers = config.getint(
+                'invoice_payment_gateway', 'onboarding_workers', default=4
+            )
+        chunk_size = config.getint(
+            'invoice_payment_gateway', 'onboarding_chunk_size', default=100
+        )
+
+        results = [{
+            'reference': row.get('reference'),
+            'status': None,
+            'profile': None,
+            'message': None,
+        } for row in rows]
+
+        existing = dict(
+            (p.onboarding_reference, p.id) for p in cls.search([
+                ('onboarding_reference', 'in',
+                    [r['reference'] for r in results if r['reference']]),
+            ])
+        )
+        to_onboard, first_rows = [], {}
+        for index, (row, result) in enumerate(zip(rows, results)):
+            if not row.get('reference'):
+                result['status'] = 'failed'
+                result['message'] = 'Missing reference'
+            elif row['reference'] in existing:
+                result['status'] = 'exists'
+                result['profile'] = existing[row['reference']]
+            elif row['reference'] not in first_rows:
+                first_rows[row['reference']] = index
+                to_onboard.append(index)
+
+        transaction = Transaction()
+        for sub_indexes in grouped_slice(to_onboard, chunk_size):
+            cls._onboard_rows(rows, results, list(sub_indexes), workers)
+            transaction.commit()
+
+        # Duplicated references in the batch are onboarded once
+        for row, result in zip(rows, results):
+            first = results[first_rows.get(result['reference'], 0)]
+            if result['status'] is None and first['status'] is not None:
+                result.update({
+                    'status': (
+                        'exists' if first['status'] == 'created'
+                        else first['status']),
+                    'profile': first['profile'],
+                    'message': first['message'],
+                })
+        return results
+
+    @classmethod
+    def _onboard_rows(cls, rows, results, indexes, workers):
+        """
+        Onboard the rows at the indexes and fill in their results.
+
+        Rows which can not be onboarded are reported as failed before any
+        card is tokenized. When the profiles can not be created at once,
+        they are created row by row so that only the rows in error fail.
+        """
+        pool = Pool()
+        Party = pool.get('party.party')
+        Gateway = pool.get('payment_gateway.gateway')
+
+        parties = dict((p.id, p) for p in Party.search([
+            ('id', 'in', list(set(
+                rows[i]['party'] for i in indexes
+                if isinstance(rows[i].get('party'), (int, long))))),
+        ]))
+        gateways = dict((g.id, g) for g in Gateway.search([
+            ('id', 'in', list(set(
+                rows[i]['gateway'] for i in indexes
+                if isinstance(rows[i].get('gateway'), (int, long))))),
+        ]))
+
+        to_tokenize, to_create, using_wizard = [], [], []
+        for index in indexes:
+            row = rows[index]
+            message = cls._check_onboarding_row(row, parties, gateways)
+            if message:
+                results[index]['status'] = 'failed'
+                results[index]['message'] = message
+                continue
+            gateway = gateways[row['gateway']]
+            if row.get('provider_reference'):
+                to_create.append((index, row['provider_reference']))
+            elif hasattr(cls, 'tokenize_card_%s' % gateway.provider):
+                to_tokenize.append((index, gateway.id, row))
+            else:
+                using_wizard.append(index)
+
+        for index, (provider_reference, message) in cls._tokenize_cards(
+                to_tokenize, workers).items():
+            if message:
+                results[index]['status'] = 'failed'
+                results[index]['message'] = message
+            else:
+                to_create.append((index, provider_reference))
+
+        to_create.sort()
+        cls._create_onboarding_profiles([
+            (index, cls._get_onboarding_values(
+                rows[index], parties[rows[index]['party']], provider_reference
+            )) for index, provider_reference in to_create
+        ], results)
+
+        for index in using_wizard:
+            row = rows[index]
+            cls._create_onboarding_profile(
+                index, results, cls._onboard_row_using_wizard,
+                row, parties[row['party']], gateways[row['gateway']]
+            )
+
+    @classmethod
+    def _check_onboarding_row(cls, row, parties, gateways):
+        """
+        Return why the onboarding row can not be onboarded, or None
+        """
+        if row.get('party') not in parties:
+            return 'Unknown party'
+        if row.get('gateway') not in gateways:
+            return 'Unknown gateway'
+        if row.get('provider_reference'):
+            keys = ['expiry_month', 'expiry_year']
+        else:
+            keys = ['owner', 'number', 'expiry_month', 'expiry_year', 'csc']
+        missing = [k for k in keys if not row.get(k)]
+        if missing:
+            return 'Missing %s' % ', '.join(missing)
+        return None
+
+    @classmethod
+    def _create_onboarding_profiles(cls, values, results):
+        """
+        Create the profiles of the onboarding rows at once, or row by row
+        when it fails, and fill in their results.
+
+        The rows created before were committed, so the failed creation is
+        rolled back before creating the profiles row by row.
+
+        :param values: List of tuples of the row index and the values of
+                       its profile
+        """
+        if not values:
+            return
+        try:
+            profiles = cls.create([v for _, v in values])
+        except Exception:
+            Transaction().rollback()
+        else:
+            for (index, _), profile in zip(values, profiles):
+                results[index]['status'] = 'created'
+                results[index]['profile'] = profile.id
+            return
+        for index, row_values in values:
+            cls._create_onboarding_profile(
+                index, results, cls._onboard_row_using_values, row_values
+            )
+
+    @classmethod
+    def _onboard_row_using_values(cls, values):
+        "Return the profile created with the values"
+        profile, = cls.create([values])
+        return profile
+
+    @classmethod
+    def _onboard_row_using_wizard(cls, row, party, gateway):
+        "Return the profile created with the wizard of the gateway"
+        profile = cls._create_from_card_using_wizard(
+            party, cls._get_onboarding_address(row, party), gateway, row
+        )
+        profile.onboarding_reference = row['reference']
+        profile.save()
+        return profile
+
+    @classmethod
+    def _create_onboarding_profile(cls, index, results, create, *args):
+        """
+        Create the profile of an onboarding row by calling `create` with
+        the arguments and commit it, or roll it back and report the row as
+        failed.
+        """
+        transaction = Transaction()
+        try:
+            profile = create(*args)
+            transaction.commit()
+        except Exception as exception:
+            transaction.rollback()
+            results[index]['status'] = 'failed'
+            results[index]['message'] = unicode(exception)
+            return
+        results[index]['status'] = 'created'
+        results[index]['profile'] = profile.id
+
+    @classmethod
+    def _get_onboarding_address(cls, row, party):
+        """
+        Return the address id of an onboarding row
+        """
+        if row.get('address'):
+            return row['address']
+        address = party.address_get('invoice')
+        return address.id if address else None
+
+    @classmethod
+    def _get_onboarding_values(cls, row, party, provider_reference):
+        """
+        Return the values to create the profile of an onboarding row
+        """
+        if row.get('number'):
+            last_4_digits = row['number'][-4:]
+        else:
+            last_4_digits = row.get('last_4_digits')
+        return {
+            'onboarding_reference': row['reference'],
+            'party': party.id,
+            'address': cls._get_onboarding_address(row, party),
+            'gateway': row['gateway'],
+            'last_4_digits': last_4_digits,
+            'expiry_month': row.get('expiry_month'),
+            'expiry_year': row.get('expiry_year'),
+            'provider_reference': provider_reference,
+        }
+
+    @classmethod
+    def _tokenize_card(cls, provider, gateway, card):
+        """
+        Tokenize the card with the gateway
+
+        :return: Tuple of the provider reference and an error message
+        """
+        try:
+            return (
+                getattr(cls, 'tokenize_card_%s' % provider)(gateway, card),
+                None
+            )
+        except Exception as exception:
+            return (None, unicode(exception))
+
+    @classmethod
+    def _tokenize_cards(cls, cards, workers):
+        """
+        Tokenize cards with at most `workers` concurrent requests
+
+        :param cards: List of tuples (key, gateway id, card)
+        :param workers: Maximum number of concurrent requests
+        :return: Dictionary mapping each key to a tuple of the provider
+                 reference and an error message
+        """
+        Gateway = Pool().get('payment_gateway.gateway')
+
+        providers = dict(
+            (g.id, g.provider) for g in Gateway.browse(
+                list(set(gateway_id for _, gateway_id, _ in cards))
+            )
+        )
+        cards = [
+            (key, gateway_id, providers[gateway_id], card)
+            for key, gateway_id, card in cards
+        ]
+        if workers <= 1 or len(cards) <= 1:
+            return dict(
+                (key, cls._tokenize_card(provider, Gateway(gateway_id), card))
+                for key, gateway_id, provider, card in cards
+            )
+
+        results = cls._tokenize_cards_in_threads(cards, workers)
+        for key, _, _, _ in cards:
+            # The worker which took the card stopped
+            results.setdefault(key, (None, 'The card was not tokenized'))
+        return results
+
+    @classmethod
+    def _tokenize_cards_in_threads(cls, cards, workers):
+        """
+        Tokenize the cards from `workers` threads
+
+        :param cards: List of tuples (key, gateway id, provider, card)
+        :return: Dictionary mapping the key of each card tokenized to a
+                 tuple of the provider reference and an error message
+        """
+        results = {}
+        queue = Queue()
+        for item in cards:
+            queue.put(item)
+
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        def worker():
+            # The transaction of the caller can not be shared between
+            # threads, the gateways are read in the one of each worker.
+            with Transaction().start(
+                    database_name, user, readonly=True, context=context):
+                Gateway = Pool().get('payment_gateway.gateway')
+                while True:
+                    try:
+                        key, gateway_id, provider, card = queue.get_nowait()
+                    except Empty:
+                        return
+                    results[key] = cls._tokenize_card(
+                        provider, Gateway(gateway_id), card
+                    )
+
+        threads = [
+            Thread(target=worker) for _ in range(min(workers, len(cards)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+from trytond.model import Workflow, ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['PaymentPlan']
+
+STATES = {
+    'readonly': Eval('state') != 'draft',
+}
+DEPENDS = ['state']
+
+
+class PaymentPlan(Workflow, ModelSQL, ModelView):
+    'Payment Plan'
+    __name__ = 'account.invoice.payment_plan'
+
+    company = fields.Many2One(
+        'company.company', 'Company', required=True, select=True,
+        states=STATES, depends=DEPENDS
+    )
+    invoice = fields.Many2One(
+        'account.invoice', 'Invoice', required=True, select=True,
+        ondelete='RESTRICT', domain=[
+            ('company', '=', Eval('company')),
+            ('type', '=', 'out'),
+            ('state', '=', 'posted'),
+        ], states=STATES, depends=DEPENDS + ['company']
+    )
+    party = fields.Function(
+        fields.Many2One('party.party', 'Party'), 'on_change_with_party'
+    )
+    payment_profile = fields.Many2One(
+        'party.payment_profile', 'Payment Profile', required=True,
+        ondelete='RESTRICT', domain=[
+            ('party', '=', Eval('party')),
+        ], states=STATES, depends=DEPENDS + ['party']
+    )
+    next_date = fields.Date(
+        'Next Charge Date', readonly=True, select=True,
+        help='Maturity date of the next installment to charge.'
+    )
+    state = fields.Selection([
+        ('draft', 'Draft'),
+        ('active', 'Active'),
+        ('done', 'Done'),
+        ('cancel', 'Canceled'),
+    ], 'State', readonly=True, select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentPlan, cls).__setup__()
+        cls._order.insert(0, ('next_date', 'ASC'))
+        cls._transitions |= set((
+            ('draft', 'active'),
+            ('draft', 'cancel'),
+            ('active', 'cancel'),
+            ('active', 'done'),
+            ('cancel', 'draft'),
+        ))
+        cls._buttons.update({
+            'activate': {
+                'invisible': Eval('state') != 'draft',
+            },
+            'cancel': {
+                'invisible': ~Eval('state').in_(['draft', 'active']),
+            },
+            'draft': {
+                'invisible': Eval('state') != 'cancel',
+            },
+        })
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @fields.depends('invoice')
+    def on_change_with_party(self, name=None):
+        if self.invoice:
+            return self.invoice.party.id
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('draft')
+    def draft(cls, plans):
+        cls.write(plans, {'next_date': None})
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('active')
+    def activate(cls, plans):
+        active = cls.search([
+            ('invoice', 'in', [p.invoice.id for p in plans]),
+            ('state', '=', 'active'),
+        ])
+        invoice_ids = [p.invoice.id for p in active + plans]
+        if len(invoice_ids) != len(set(invoice_ids)):
+            cls.raise_user_error(
+                'An invoice can not have more than one active payment plan'
+            )
+        for plan in plans:
+            plan.next_date = plan.get_next_date()
+            if plan.next_date is None:
+                cls.raise_user_error(
+                    'The invoice "%s" has nothing left to pay'
+                    % plan.invoice.rec_name
+                )
+        cls.save(plans)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('cancel')
+    def cancel(cls, plans):
+        pass
+
+    @classmethod
+    @Workflow.transition('done')
+    def done(cls, plans):
+        cls.write(plans, {'next_date': None})
+
+    def get_next_date(self):
+        """
+        Return the maturity date of the next installment left to charge, or
+        None when the invoice has nothing left to pay.
+
+        Once the installments due today are paid, the next one is the
+        earliest later maturity. Otherwise the charge of the installments
+        due is tried again.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        AccountConfiguration = pool.get('account.configuration')
+
+        today = Date.today()
+        if self.invoice.state != 'posted':
+            return None
+        maturities = sorted(
+            l.maturity_date or today for l in self.invoice.lines_to_pay
+            if not l.reconciliation
+        )
+        if not maturities:
+            return None
+        threshold = AccountConfiguration(1).write_off_threshold
+        if self.invoice.amount_to_pay_today > threshold:
+            return maturities[0]
+        later = [d for d in maturities if d > today]
+        return later[0] if later else None
+
+    @classmethod
+    def update_next_date(cls, plans):
+        """
+        Set the date of the next installment of the plans, and mark as done
+        the plans of invoices left with nothing to charge
+        """
+        to_write, to_done = {}, []
+        for plan in plans:
+            next_date = plan.get_next_date()
+            if next_date is None:
+                to_done.append(plan)
+            elif next_date != plan.next_date:
+                to_write.setdefault(next_date, []).append(plan)
+        for next_date, date_plans in to_write.items():
+            cls.write(date_plans, {'next_date': next_date})
+        cls.done(to_done)
+
+    @classmethod
+    def charge_due_plans(cls):
+        """
+        Charge the installments due of the active payment plans on the
+        payment profile of each plan, through the batch capture of the
+        invoices, and move the plans to their next installment.
+
+        The plans due are selected with a single query on the indexed next
+        charge date, which includes the installments missed by earlier
+        runs.
+
+        This method is meant to be called by the scheduler.
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Date = pool.get('ir.date')
+
+        plans = cls.search([
+            ('state', '=', 'active'),
+            ('next_date', '<=', Date.today()),
+        ], order=[('next_date', 'ASC'), ('id', 'ASC')])
+        for sub_plans in grouped_slice(plans):
+            sub_plans = list(sub_plans)
+            Invoice.batch_capture_and_pay(
+                [p.invoice for p in sub_plans],
+                payment_profiles=dict(
+                    (p.invoice.id, p.payment_profile) for p in sub_plans
+                )
+            )
+            cls.update_next_date(sub_plans)
+        return plans
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import datetime
+import pstats
+import threading
+import time
+from functools import wraps
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from trytond.model import fields
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+__all__ = ['User', 'profile_payment']
+__metaclass__ = PoolMeta
+
+_local = threading.local()
+
+
+def profile_payment(func):
+    """
+    Decorator profiling the decorated payment method with cProfile when
+    `profile_payments` is set in the context, which it is for the users
+    with the setting enabled. The profile is attached to the invoice.
+
+    Only the outermost decorated method is profiled. The attachment is
+    rolled back with the transaction when the method fails.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if (not Transaction().context.get('profile_payments')
+                or getattr(_local, 'profiling', False)):
+            return func(self, *args, **kwargs)
+        _local.profiling = True
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            result = profiler.runcall(func, self, *args, **kwargs)
+        finally:
+            _local.profiling = False
+        if self.__name__ == 'account.invoice':
+            invoice = self
+        else:
+            invoice = self.start.invoice
+        _attach_profile(
+            invoice, func.__name__, profiler, time.time() - start
+        )
+        return result
+    return wrapper
+
+
+def _attach_profile(invoice, name, profiler, duration):
+    """
+    Attach the report of the profiler to the invoice: the time spent in
+    SQL queries first, then the functions by cumulative time.
+    """
+    Attachment = Pool().get('ir.attachment')
+
+    stats = pstats.Stats(profiler)
+    sql_calls, sql_time = 0, 0.
+    for (_, _, function), stat in stats.stats.items():
+        # Time spent in the cursors of the database driver
+        if function.startswith('<method \'execute'):
+            sql_calls += stat[1]
+            sql_time += stat[3]
+
+    report = StringIO()
+    report.write('%s of invoice %s by user %s\n' % (
+        name, invoice.id, Transaction().user))
+    report.write('Duration: %.1f ms\n' % (duration * 1000))
+    report.write('SQL: %d queries in %.1f ms\n\n' % (
+        sql_calls, sql_time * 1000))
+    stats.stream = report
+    stats.sort_stats('cumulative').print_stats(50)
+
+    now = datetime.datetime.now()
+    with Transaction().set_user(0):
+        Attachment.create([{
+            'name': 'profile-%s-%s.txt' % (
+                name, now.strftime('%Y%m%d%H%M%S%f')),
+            'resource': str(invoice),
+            'type': 'data',
+            'data': report.getvalue(),
+        }])
+
+
+class User:
+    __name__ = 'res.user'
+
+    profile_payments = fields.Boolean(
+        'Profile Payments',
+        help='Attach a profile of each payment made by the user to the '
+        'invoice.'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(User, cls).__setup__()
+        cls._context_fields.append('profile_payments')
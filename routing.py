@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+
+from trytond.config import config
+
+__all__ = ['GatewayHealth', 'gateway_health']
+
+
+class GatewayHealth(object):
+    """
+    Latency and error rate of the gateways observed by this process over a
+    rolling window, with a circuit breaker per gateway.
+
+    Calls raising an exception or slower than the timeout are gateway
+    errors, while cards declined by a gateway are not. The circuit of a
+    gateway opens when its error rate over the window reaches the
+    threshold, once the gateway had `min_calls` calls. No capture is
+    routed to it until the open duration elapsed, then a single trial
+    capture closes the circuit again if it succeeds. Other captures are
+    kept away from the gateway while the trial is in flight, or until it
+    is considered lost after the open duration.
+    """
+
+    def __init__(
+        self, window=60, error_rate=0.5, min_calls=5, open_duration=30,
+        timeout=30
+    ):
+        self.window = window
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.open_duration = open_duration
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._opened = {}
+        self._trials = {}
+
+    def _expire(self, calls, now):
+        while calls and calls[0][0] < now - self.window:
+            calls.popleft()
+
+    def record(self, gateway_id, latency, error):
+        """
+        Record the outcome of a call to a gateway
+
+        :param gateway_id: Id of the gateway
+        :param latency: Duration of the call in seconds
+        :param error: True if the call raised an exception, calls slower
+                      than the timeout are errors too
+        """
+        now = time.time()
+        error = error or latency >= self.timeout
+        with self._lock:
+            calls = self._calls.setdefault(gateway_id, deque())
+            if gateway_id in self._opened:
+                self._trials.pop(gateway_id, None)
+                if error:
+                    self._opened[gateway_id] = now
+                else:
+                    # The trial call succeeded, forget the failures
+                    del self._opened[gateway_id]
+                    calls.clear()
+                calls.append((now, latency, error))
+                return
+
+            calls.append((now, latency, error))
+            self._expire(calls, now)
+            errors = len([c for c in calls if c[2]])
+            if (len(calls) >= self.min_calls
+                    and float(errors) / len(calls) >= self.error_rate):
+                self._opened[gateway_id] = now
+
+    def _is_trial_due(self, gateway_id, now):
+        "Return True if the trial call of the open circuit can be made"
+        if now - self._opened[gateway_id] < self.open_duration:
+            return False
+        trial = self._trials.get(gateway_id)
+        return trial is None or now - trial >= self.open_duration
+
+    def is_available(self, gateway_id):
+        """
+        Return True if a capture can be routed to the gateway.
+
+        When the circuit of the gateway is open and its trial call is due,
+        the capture is the trial call: the other captures are refused
+        until its outcome is recorded.
+        """
+        now = time.time()
+        with self._lock:
+            if gateway_id not in self._opened:
+                return True
+            if not self._is_trial_due(gateway_id, now):
+                return False
+            self._trials[gateway_id] = now
+            return True
+
+    def is_healthy(self, gateway_id):
+        """
+        Return True if the circuit of the gateway is closed and its error
+        rate is under the threshold, or the gateway had less than
+        `min_calls` calls over the window
+        """
+        now = time.time()
+        with self._lock:
+            if gateway_id in self._opened:
+                return False
+            calls = self._calls.get(gateway_id, deque())
+            self._expire(calls, now)
+            if len(calls) < self.min_calls:
+                return True
+            errors = len([c for c in calls if c[2]])
+            return float(errors) / len(calls) < self.error_rate
+
+    def get_stats(self, gateway_id):
+        """
+        Return the error rate and the mean latency of the gateway over the
+        window
+        """
+        now = time.time()
+        with self._lock:
+            calls = self._calls.get(gateway_id)
+            if not calls:
+                return 0., 0.
+            self._expire(calls, now)
+            if not calls:
+                return 0., 0.
+            errors = len([c for c in calls if c[2]])
+            return (
+                float(errors) / len(calls),
+                sum(c[1] for c in calls) / len(calls))
+
+    def sort(self, gateway_ids):
+        """
+        Return the gateways with a closed circuit ordered from the
+        healthiest, by error rate then latency, followed by the gateways
+        whose trial call is due. Gateways in the same state keep the given
+        order.
+        """
+        now = time.time()
+        with self._lock:
+            closed = [g for g in gateway_ids if g not in self._opened]
+            trials = [
+                g for g in gateway_ids
+                if g in self._opened and self._is_trial_due(g, now)
+            ]
+        return sorted(closed, key=self.get_stats) + trials
+
+    def route(self, gateway_ids, preferred=None):
+        """
+        Return the gateway to route a capture to: the preferred one while
+        it is healthy, otherwise the healthiest available one, or None.
+
+        :param gateway_ids: List of the gateway ids, in order of preference
+        :param preferred: Id of the gateway asked for (optional)
+        """
+        if preferred is not None and self.is_healthy(preferred):
+            return preferred
+        for gateway_id in self.sort(gateway_ids):
+            if self.is_available(gateway_id):
+                return gateway_id
+        return None
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._opened.clear()
+            self._trials.clear()
+
+
+gateway_health = GatewayHealth(
+    window=config.getint(
+        'invoice_payment_gateway', 'routing_window', default=60),
+    error_rate=config.getfloat(
+        'invoice_payment_gateway', 'routing_error_rate', default=0.5),
+    min_calls=config.getint(
+        'invoice_payment_gateway', 'routing_min_calls', default=5),
+    open_duration=config.getint(
+        'invoice_payment_gateway', 'routing_open_duration', default=30),
+    timeout=config.getfloat(
+        'invoice_payment_gateway', 'routing_timeout', default=30),
+)
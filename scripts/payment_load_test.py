@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator for the payment RPCs of invoice_payment_gateway
+
+Pays posted customer invoices of a local database from concurrent workers,
+either through `account.invoice.capture_and_pay_using_transaction` or the
+`account.invoice.pay_using_transaction` wizard, and reports throughput,
+latency percentiles, lock conflicts and errors.
+
+Use a gateway of the dummy provider as the local stub gateway:
+
+    python scripts/payment_load_test.py -c trytond.conf -d loadtest \\
+        --gateway 1 --profile 1 --workers 8 --requests 200
+
+Every request pays `--amount` of a random invoice, so that workers compete
+for the same invoices like cashiers and batch workers do in production.
+"""
+import argparse
+import math
+import random
+import sys
+import threading
+import time
+from decimal import Decimal
+
+
+def percentile(values, percent):
+    "Return the nearest-rank percentile of sorted values"
+    if not values:
+        return 0.
+    index = int(math.ceil(percent / 100. * len(values))) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class Statistics(object):
+    "Thread safe collector of the request outcomes"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.lock_conflicts = 0
+        self.errors = {}
+
+    def success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def lock_conflict(self):
+        with self.lock:
+            self.lock_conflicts += 1
+
+    def error(self, exception):
+        name = exception.__class__.__name__
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, duration, out=sys.stdout):
+        latencies = sorted(self.latencies)
+        total = (
+            len(latencies) + self.lock_conflicts + sum(self.errors.values()))
+        out.write('Requests:        %d in %.2fs\n' % (total, duration))
+        out.write('Throughput:      %.2f payments/s\n' % (
+            len(latencies) / duration if duration else 0.))
+        for percent in (50, 95, 99):
+            out.write('Latency p%d:     %.1f ms\n' % (
+                percent, percentile(latencies, percent) * 1000))
+        out.write('Lock conflicts:  %d (%.1f%%)\n' % (
+            self.lock_conflicts,
+            100. * self.lock_conflicts / total if total else 0.))
+        out.write('Errors:          %d (%.1f%%)\n' % (
+            sum(self.errors.values()),
+            100. * sum(self.errors.values()) / total if total else 0.))
+        for name, count in sorted(self.errors.items()):
+            out.write('    %s: %d\n' % (name, count))
+
+
+def pay_using_rpc(pool, invoice, options):
+    invoice.capture_and_pay_using_transaction(
+        options.profile, options.gateway, options.amount
+    )
+
+
+def pay_using_wizard(pool, invoice, options):
+    from trytond.transaction import Transaction
+
+    Wizard = pool.get('account.invoice.pay_using_transaction', type='wizard')
+    Gateway = pool.get('payment_gateway.gateway')
+
+    gateway = Gateway(options.gateway)
+    session_id, _, _ = Wizard.create()
+    with Transaction().set_context(active_id=invoice.id):
+        wizard = Wizard(session_id)
+        defaults = wizard.default_start()
+        for name in ('invoice', 'party', 'company', 'credit_account',
+                'owner', 'currency_digits', 'user', 'transaction_type'):
+            setattr(wizard.start, name, defaults[name])
+        wizard.start.amount = options.amount
+        wizard.start.gateway = gateway
+        wizard.start.method = gateway.method
+        wizard.start.use_existing_card = True
+        wizard.start.payment_profile = options.profile
+        wizard.start.transaction = None
+        wizard.start.reference = 'Load test'
+        if wizard.transition_pay() == 'failed':
+            raise Exception(wizard.failed.message)
+    Wizard.delete(session_id)
+
+
+def worker(options, user_id, context, invoice_ids, requests, statistics):
+    from trytond import backend
+    from trytond.exceptions import UserError
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    DatabaseOperationalError = backend.get('DatabaseOperationalError')
+    pay = pay_using_wizard if options.mode == 'wizard' else pay_using_rpc
+
+    for _ in range(requests):
+        invoice_id = random.choice(invoice_ids)
+        start = time.time()
+        with Transaction().start(
+                options.database, user_id, context=context) as transaction:
+            pool = Pool()
+            Invoice = pool.get('account.invoice')
+            try:
+                pay(pool, Invoice(invoice_id), options)
+                transaction.commit()
+            except (UserError, DatabaseOperationalError) as exception:
+                transaction.rollback()
+                if 'being paid' in unicode(exception):
+                    statistics.lock_conflict()
+                elif isinstance(exception, DatabaseOperationalError):
+                    # Serialization failures and lock timeouts
+                    statistics.lock_conflict()
+                else:
+                    statistics.error(exception)
+                continue
+            except Exception as exception:
+                transaction.rollback()
+                statistics.error(exception)
+                continue
+        statistics.success(time.time() - start)
+
+
+def main(options):
+    from trytond.config import config
+    config.update_etc(options.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+
+    with Transaction().start(options.database, 0, readonly=True):
+        User = pool.get('res.user')
+        Invoice = pool.get('account.invoice')
+
+        user, = User.search([('login', '=', options.user)])
+        context = User.get_preferences(context_only=True)
+        context['use_dummy'] = True
+        invoices = Invoice.search([
+            ('type', '=', 'out'),
+            ('state', '=', 'posted'),
+        ], limit=options.invoices)
+        invoice_ids = [i.id for i in invoices if i.amount_to_pay > 0]
+    if not invoice_ids:
+        sys.exit('No posted customer invoice left to pay')
+
+    statistics = Statistics()
+    per_worker, extra = divmod(options.requests, options.workers)
+    threads = [
+        threading.Thread(target=worker, args=(
+            options, user.id, context, invoice_ids,
+            per_worker + (1 if index < extra else 0), statistics))
+        for index in range(options.workers)
+    ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    statistics.report(time.time() - start)
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(
+        description='Load test the invoice payment RPCs')
+    parser.add_argument('-c', '--config', dest='config', default=None,
+        help='trytond configuration file')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='user', default='admin',
+        help='login of the user paying the invoices')
+    parser.add_argument('--mode', choices=['rpc', 'wizard'], default='rpc')
+    parser.add_argument('--gateway', type=int, required=True,
+        help='id of the stub gateway')
+    parser.add_argument('--profile', type=int, required=True,
+        help='id of the payment profile to charge')
+    parser.add_argument('--amount', type=Decimal, default=Decimal('0.01'),
+        help='amount paid by each request')
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('--invoices', type=int, default=100,
+        help='number of invoices the requests are spread over')
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+HTTP receiver for the asynchronous notifications of the payment gateways
+
+Accepts POST requests to the path of a gateway id whose body is a JSON
+list of notifications, or a single one, signed by the gateway in the
+X-Signature header. The body and the signature are passed as received to
+`account.invoice.payment_notification.receive`, which verifies the
+signature and applies the notifications in one transaction per request.
+The response is the JSON list of the statuses of the notifications. Only
+a payload not signed by the gateway is refused with a 403 status. Any
+other failed request, like an invoice being paid by another worker,
+returns a 500 status so that the gateway delivers the notifications
+again.
+
+It serves as the local stand-in of the gateways when testing, with the
+dummy_notification_secret of the invoice_payment_gateway section as the
+key of the dummy gateways:
+
+    python scripts/payment_webhook_server.py -c trytond.conf -d test \\
+        --port 8010
+
+    curl -X POST localhost:8010/1 -H "X-Signature: $SIGNATURE" \\
+        -d '[{"event_id": "evt_1", "event": "captured",
+        "provider_reference": "ch_1"}]'
+"""
+import argparse
+import json
+import sys
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def receive(options, user_id, context, gateway_id, payload, signature):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    with Transaction().start(
+            options.database, user_id, context=context) as transaction:
+        Notification = Pool().get('account.invoice.payment_notification')
+        try:
+            results = Notification.receive(gateway_id, payload, signature)
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            raise
+    return results
+
+
+def get_handler(options, user_id, context):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            from trytond.modules.invoice_payment_gateway.notification \
+                import NotificationSignatureError
+
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                gateway_id = int(self.path.strip('/'))
+            except ValueError:
+                self.send_error(404, 'Unknown gateway')
+                return
+            try:
+                results = receive(
+                    options, user_id, context, gateway_id,
+                    self.rfile.read(length), self.headers.get('X-Signature'))
+            except NotificationSignatureError as exception:
+                self.send_error(403, exception.message)
+                return
+            except Exception as exception:
+                self.send_error(500, str(exception))
+                return
+            body = json.dumps(results)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def main(options):
+    from trytond.config import config
+    config.update_etc(options.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+
+    with Transaction().start(options.database, 0, readonly=True):
+        User = pool.get('res.user')
+
+        user, = User.search([('login', '=', options.user)])
+        context = User.get_preferences(context_only=True)
+
+    server = HTTPServer(
+        (options.host, options.port),
+        get_handler(options, user.id, context))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(
+        description='Receive the notifications of the payment gateways')
+    parser.add_argument('-c', '--config', dest='config', default=None,
+        help='trytond configuration file')
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-u', '--user', dest='user', default='admin',
+        help='login of the user applying the notifications')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8010)
+    return parser.parse_args(arguments)
+
+
+if __name__ == '__main__':
+    main(parse_arguments(sys.argv[1:]))
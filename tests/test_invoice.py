@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
 import unittest
 import datetime
+import csv
+import hashlib
+import hmac
+import json
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.tests.test_tryton import (
     POOL, USER, CONTEXT,
     with_transaction, ModuleTestCase
 )
+from trytond.config import config
+from trytond.exceptions import UserError
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 
+from trytond.modules.invoice_payment_gateway.gateway import RateTable
+from trytond.modules.invoice_payment_gateway.notification import \
+    NotificationSignatureError
+from trytond.modules.invoice_payment_gateway.routing import (
+    GatewayHealth, gateway_health
+)
+
 
 class TestInvoice(ModuleTestCase):
     """
@@ -152,6 +166,7 @@ class TestInvoice(ModuleTestCase):
         AddPaymentProfileWizard = POOL.get(
             'party.party.payment_profile.add', type='wizard'
         )
+        Date = POOL.get('ir.date')
 
         # create a profile
         profile_wiz = AddPaymentProfileWizard(
@@ -164,15 +179,16 @@ class TestInvoice(ModuleTestCase):
         profile_wiz.card_info.owner = party.name
         profile_wiz.card_info.number = '4111111111111111'
         profile_wiz.card_info.expiry_month = '11'
-        profile_wiz.card_info.expiry_year = '2018'
+        profile_wiz.card_info.expiry_year = '%s' % (Date.today().year + 3)
         profile_wiz.card_info.csc = '353'
 
         with Transaction().set_context(return_profile=True):
             return profile_wiz.transition_add()
 
-    def create_and_post_invoice(self, party):
+    def create_and_post_invoice(self, party, payment_term=None, currency=None):
         """
-        Create and post an invoice for the party
+        Create and post an invoice for the party, in the currency of the
+        company unless another one is given
         """
         Date = POOL.get('ir.date')
 
@@ -185,7 +201,8 @@ class TestInvoice(ModuleTestCase):
                     'invoice'),
                 'account': self._get_account_by_kind('receivable'),
                 'description': 'Test Invoice',
-                'payment_term': self.payment_term,
+                'currency': currency or self.company.currency,
+                'payment_term': payment_term or self.payment_term,
                 'invoice_date': Date.today(),
                 'lines': [('create', [{
                     'product': self.product1.id,
@@ -207,6 +224,66 @@ class TestInvoice(ModuleTestCase):
         self.Invoice.post([invoice])
         return invoice
 
+    def create_euro(self, rate):
+        """
+        Create the euro at the rate of today, against a rate of 1 for the
+        currency of the company
+        """
+        Date = POOL.get('ir.date')
+
+        today = Date.today()
+        self.Currency.write([self.company.currency], {
+            'rates': [('create', [{'date': today, 'rate': Decimal('1')}])],
+        })
+        euro, = self.Currency.create([{
+            'name': 'Euro',
+            'code': 'EUR',
+            'symbol': 'E',
+            'rates': [('create', [{'date': today, 'rate': rate}])],
+        }])
+        return euro
+
+    def create_and_post_credit_note(self, party, quantity, currency=None):
+        """
+        Create and post a credit note for the party, in the currency of the
+        company unless another one is given
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().set_context(company=self.company.id):
+            credit_note, = self.Invoice.create([{
+                'party': party,
+                'type': 'out',
+                'journal': self.journal,
+                'invoice_address': self.party.address_get(
+                    'invoice'),
+                'account': self._get_account_by_kind('receivable'),
+                'description': 'Test Credit Note',
+                'currency': currency or self.company.currency,
+                'payment_term': self.payment_term,
+                'invoice_date': Date.today(),
+                'lines': [('create', [{
+                    'product': self.product1.id,
+                    'description': self.product1.rec_name,
+                    'quantity': -quantity,
+                    'unit_price': Decimal('10.00'),
+                    'unit': self.product1.default_uom,
+                    'account': self.product1.account_revenue_used
+                }])]
+            }])
+
+        self.Invoice.post([credit_note])
+        return credit_note
+
+    def keep_commits(self):
+        """
+        Make the commits of the tested code no-ops until the end of the test,
+        so that what it commits stays in the transaction of the test
+        """
+        transaction = Transaction()
+        transaction.commit = lambda: None
+        self.addCleanup(delattr, transaction, 'commit')
+
     def setup_defaults(self):
         """Creates default data for testing
         """
@@ -565,6 +642,1411 @@ class TestInvoice(ModuleTestCase):
         self.assertEqual(invoice.state, 'paid')
         self.assertFalse(invoice.amount_to_pay)
 
+    @with_transaction()
+    def test_0050_test_authorize_on_post_and_capture_in_bulk(self):
+        """
+        Authorize invoices when posted and capture them with the scheduler
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        self.setup_defaults()
+
+        account_config = self.AccountConfiguration(1)
+        account_config.authorize_on_post = True
+        account_config.save()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+
+            transaction, = PaymentTransaction.search([
+                ('origin', '=', '%s,%s' % (invoice.__name__, invoice.id)),
+            ])
+            self.assertEqual(transaction.state, 'authorized')
+            self.assertEqual(
+                transaction.payment_profile, self.dummy_cc_payment_profile
+            )
+            self.assertEqual(transaction.amount, invoice.amount_to_pay)
+            self.assertEqual(invoice.state, 'posted')
+
+            captured = self.Invoice.capture_authorized_transactions()
+
+        self.assertEqual(captured, [transaction])
+        self.assertIn(transaction.state, ('completed', 'posted'))
+        self.assertEqual(invoice.state, 'paid')
+        self.assertFalse(invoice.amount_to_pay)
+
+    @with_transaction()
+    def test_0060_test_create_payment_profile_from_card(self):
+        """
+        Create a payment profile without the add payment profile wizard
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+        Date = POOL.get('ir.date')
+
+        self.setup_defaults()
+
+        expiry_year = '%s' % (Date.today().year + 3)
+        profile = PaymentProfile.create_from_card(
+            self.party, self.party.addresses[0], self.dummy_gateway, {
+                'owner': self.party.name,
+                'number': '4111111111111111',
+                'expiry_month': '05',
+                'expiry_year': expiry_year,
+                'csc': '435',
+            }
+        )
+
+        self.assertTrue(profile.id)
+        self.assertTrue(profile.provider_reference)
+        self.assertEqual(profile.party, self.party)
+        self.assertEqual(profile.gateway, self.dummy_gateway)
+        self.assertEqual(profile.last_4_digits, '1111')
+        self.assertEqual(profile.expiry_month, '05')
+        self.assertEqual(profile.expiry_year, expiry_year)
+
+    @with_transaction()
+    def test_0070_test_onboard_cards_in_bulk(self):
+        """
+        Onboard cards and tokens in bulk and resume an onboarding run
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+
+        self.setup_defaults()
+        # Keep the profiles of each chunk in the transaction of the test
+        self.keep_commits()
+
+        rows = [{
+            'reference': 'CUST-1',
+            'party': self.party.id,
+            'gateway': self.dummy_gateway.id,
+            'owner': self.party.name,
+            'number': '4111111111111111',
+            'expiry_month': '05',
+            'expiry_year': '2030',
+            'csc': '435',
+        }, {
+            'reference': 'CUST-2',
+            'party': self.party.id,
+            'address': self.party.addresses[0].id,
+            'gateway': self.dummy_gateway.id,
+            'provider_reference': 'tok_migrated',
+            'last_4_digits': '4242',
+            'expiry_month': '12',
+            'expiry_year': '2031',
+        }]
+        bad_rows = [
+            dict(rows[1], reference='CUST-3', gateway=-1),
+            dict(rows[0], reference='CUST-4', csc=None),
+            dict(rows[1], reference=None),
+        ]
+
+        results = PaymentProfile.onboard_cards(rows + bad_rows, workers=1)
+
+        self.assertEqual(
+            [r['status'] for r in results],
+            ['created', 'created', 'failed', 'failed', 'failed']
+        )
+        self.assertEqual(
+            [r['message'] for r in results[2:]],
+            ['Unknown gateway', 'Missing csc', 'Missing reference']
+        )
+        card_profile = PaymentProfile(results[0]['profile'])
+        self.assertEqual(card_profile.last_4_digits, '1111')
+        self.assertEqual(card_profile.onboarding_reference, 'CUST-1')
+        token_profile = PaymentProfile(results[1]['profile'])
+        self.assertEqual(token_profile.provider_reference, 'tok_migrated')
+        self.assertEqual(token_profile.last_4_digits, '4242')
+
+        # Sending the rows again does not create the profiles twice
+        results = PaymentProfile.onboard_cards(rows, workers=1)
+
+        self.assertEqual([r['status'] for r in results], ['exists', 'exists'])
+        self.assertEqual(
+            [r['profile'] for r in results],
+            [card_profile.id, token_profile.id]
+        )
+
+    @with_transaction()
+    def test_0080_test_refund_split_over_transactions(self):
+        """
+        Refund a credit note larger than any single charge of the party
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice1 = self.create_and_post_invoice(self.party)
+            invoice2 = self.create_and_post_invoice(self.party)
+            for invoice in (invoice1, invoice2):
+                invoice.capture_and_pay_using_transaction(
+                    self.dummy_cc_payment_profile.id,
+                    self.dummy_gateway.id, invoice.amount_to_pay
+                )
+            self.assertEqual(invoice1.state, 'paid')
+            self.assertEqual(invoice2.state, 'paid')
+            charge1, = PaymentTransaction.search([
+                ('origin', '=', '%s,%s' % (invoice1.__name__, invoice1.id)),
+            ])
+            charge2, = PaymentTransaction.search([
+                ('origin', '=', '%s,%s' % (invoice2.__name__, invoice2.id)),
+            ])
+
+            credit_note = self.create_and_post_credit_note(self.party, 45)
+            self.assertEqual(credit_note.amount_to_pay, Decimal('-450'))
+
+        Wizard = POOL.get(
+            'account.invoice.pay_using_transaction', type='wizard'
+        )
+        with Transaction().set_context(active_id=credit_note.id):
+            pay_wizard = Wizard(Wizard.create()[0])
+            defaults = pay_wizard.default_start()
+            self.assertEqual(defaults['transaction_type'], 'refund')
+
+            pay_wizard.start.invoice = defaults['invoice']
+            pay_wizard.start.party = defaults['party']
+            pay_wizard.start.company = defaults['company']
+            pay_wizard.start.credit_account = defaults['credit_account']
+            pay_wizard.start.currency_digits = defaults['currency_digits']
+            pay_wizard.start.amount = defaults['amount']
+            pay_wizard.start.user = defaults['user']
+            pay_wizard.start.gateway = self.dummy_gateway.id
+            pay_wizard.start.method = self.dummy_gateway.method
+            pay_wizard.start.transaction = None
+            pay_wizard.start.transaction_type = defaults['transaction_type']
+
+            with Transaction().set_context(company=self.company.id):
+                self.assertEqual(pay_wizard.transition_pay(), 'end')
+
+        # The newest charge is refunded completely, the remainder from the
+        # previous one
+        self.assertEqual(charge2.amount_available_for_refund, Decimal('0'))
+        self.assertEqual(
+            charge1.amount_available_for_refund, Decimal('150')
+        )
+        self.assertEqual(credit_note.state, 'paid')
+        self.assertFalse(credit_note.amount_to_pay)
+
+    @with_transaction()
+    def test_0090_test_batch_capture_nets_credit_notes(self):
+        """
+        Net open credit notes before charging the invoices of a party
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            credit_note = self.create_and_post_credit_note(self.party, 10)
+            self.assertEqual(invoice.amount_to_pay, Decimal('300'))
+            self.assertEqual(credit_note.amount_to_pay, Decimal('-100'))
+
+            transaction, = self.Invoice.batch_capture_and_pay([invoice])
+
+        self.assertEqual(transaction.amount, Decimal('200'))
+        self.assertEqual(transaction.origin, invoice)
+        self.assertEqual(invoice.state, 'paid')
+        self.assertEqual(credit_note.state, 'paid')
+
+    @with_transaction()
+    def test_0100_test_reconcile_installments(self):
+        """
+        Reconcile each installment of an invoice as soon as it is paid
+        """
+        PaymentTerm = POOL.get('account.invoice.payment_term')
+
+        self.setup_defaults()
+
+        payment_term, = PaymentTerm.create([{
+            'name': 'Two Installments',
+            'lines': [('create', [{
+                'type': 'percent',
+                'ratio': Decimal('0.5'),
+                'divisor': Decimal('2'),
+                'relativedeltas': [('create', [{'days': 0}])],
+            }, {
+                'type': 'remainder',
+                'relativedeltas': [('create', [{'months': 1}])],
+            }])],
+        }])
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(
+                self.party, payment_term=payment_term
+            )
+            first, second = sorted(
+                invoice.lines_to_pay, key=lambda l: l.maturity_date
+            )
+            self.assertEqual(first.debit, Decimal('150'))
+
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('150')
+            )
+            self.assertTrue(first.reconciliation)
+            self.assertFalse(second.reconciliation)
+            self.assertEqual(invoice.state, 'posted')
+            self.assertEqual(invoice.amount_to_pay, Decimal('150'))
+
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('150')
+            )
+
+        self.assertTrue(second.reconciliation)
+        self.assertNotEqual(first.reconciliation, second.reconciliation)
+        self.assertEqual(invoice.state, 'paid')
+
+    @with_transaction()
+    def test_0110_test_charge_run_shards(self):
+        """
+        Split the invoices of a charge run into shards by party
+        """
+        ChargeRun = POOL.get('account.invoice.charge_run')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            party2, = self.Party.create([{
+                'name': 'Dick Grayson',
+                'addresses': [('create', [{
+                    'name': 'Dick Grayson',
+                    'invoice': True,
+                }])],
+                'account_receivable': self._get_account_by_kind(
+                    'receivable').id,
+            }])
+            invoice1 = self.create_and_post_invoice(self.party)
+            invoice2 = self.create_and_post_invoice(party2)
+
+            run, = ChargeRun.create([{
+                'shard_count': 2,
+            }])
+            ChargeRun.start([run])
+
+        self.assertEqual(run.state, 'running')
+        self.assertEqual([s.number for s in run.shards], [0, 1])
+        self.assertEqual(
+            [s.state for s in run.shards], ['pending', 'pending']
+        )
+
+        shard_ids = [run.get_invoice_ids(s.number) for s in run.shards]
+        self.assertEqual(
+            sorted(sum(shard_ids, [])), sorted([invoice1.id, invoice2.id])
+        )
+        self.assertEqual(
+            shard_ids[self.party.id % 2], [invoice1.id]
+        )
+        self.assertEqual(shard_ids[party2.id % 2], [invoice2.id])
+        self.assertEqual(run.invoice_count, 0)
+        self.assertEqual(run.shards_done, 0)
+
+    @with_transaction()
+    def test_0120_test_simulate_batch_capture(self):
+        """
+        Simulate a batch capture without calling the gateway
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        PaymentProfile = POOL.get('party.payment_profile')
+        Date = POOL.get('ir.date')
+        Attachment = POOL.get('ir.attachment')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            party2, = self.Party.create([{
+                'name': 'Dick Grayson',
+                'addresses': [('create', [{
+                    'name': 'Dick Grayson',
+                    'invoice': True,
+                }])],
+                'account_receivable': self._get_account_by_kind(
+                    'receivable').id,
+            }])
+            profile = PaymentProfile.create_from_card(
+                self.party, self.party.addresses[0], self.dummy_gateway, {
+                    'owner': self.party.name,
+                    'number': '4111111111111111',
+                    'expiry_month': '05',
+                    'expiry_year': '%s' % (Date.today().year + 3),
+                    'csc': '435',
+                }
+            )
+            invoice1 = self.create_and_post_invoice(self.party)
+            invoice2 = self.create_and_post_invoice(party2)
+
+            summary = self.Invoice.simulate_batch_capture(
+                [invoice1, invoice2], detail=True
+            )
+            attachment = Attachment(summary['detail'])
+
+        self.assertEqual(summary['invoices'], 2)
+        self.assertEqual(summary['charges'], [{
+            'gateway': self.dummy_gateway.name,
+            'currency': 'USD',
+            'count': 1,
+            'amount': Decimal('300'),
+        }])
+        self.assertEqual(summary['skipped'], {'no_profile': 1})
+        self.assertEqual(attachment.resource, self.company)
+        rows = csv.DictReader(str(attachment.data).splitlines())
+        self.assertEqual(
+            [
+                (r['invoice'], r['payment_profile'], r['status'])
+                for r in rows
+            ], [
+                (str(invoice1.id), str(profile.id), 'charge'),
+                (str(invoice2.id), '', 'no_profile'),
+            ]
+        )
+        self.assertFalse(PaymentTransaction.search([]))
+        self.assertEqual(invoice1.state, 'posted')
+
+    @with_transaction()
+    def test_0130_test_unusable_payment_profiles(self):
+        """
+        Leave out expired payment profiles before charging
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        PaymentProfile = POOL.get('party.payment_profile')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            expired_profile = PaymentProfile.create_from_card(
+                self.party, self.party.addresses[0], self.dummy_gateway, {
+                    'owner': self.party.name,
+                    'number': '4111111111111111',
+                    'expiry_month': '01',
+                    'expiry_year': '2015',
+                    'csc': '435',
+                }
+            )
+            PaymentProfile.write([self.dummy_cc_payment_profile], {
+                'active': False,
+            })
+            invoice = self.create_and_post_invoice(self.party)
+
+            report = self.Invoice.get_unusable_payment_profiles([invoice])
+            self.assertEqual(report, [{
+                'party': self.party.id,
+                'party_name': self.party.rec_name,
+                'payment_profile': expired_profile.id,
+                'reason': 'expired_card',
+                'invoices': [invoice.id],
+            }])
+            self.assertIsNone(invoice.get_default_payment_profile())
+
+            self.assertEqual(self.Invoice.batch_capture_and_pay([invoice]), [])
+
+        self.assertFalse(PaymentTransaction.search([]))
+        self.assertEqual(invoice.state, 'posted')
+
+    @with_transaction()
+    def test_0140_test_capture_routed_to_healthy_gateway(self):
+        """
+        Route a capture to another profile when the gateway is failing
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        PaymentProfile = POOL.get('party.payment_profile')
+        Date = POOL.get('ir.date')
+
+        self.setup_defaults()
+        gateway_health.reset()
+        self.addCleanup(gateway_health.reset)
+
+        with Transaction().set_context(use_dummy=True):
+            backup_gateway, = self.PaymentGateway.create([{
+                'name': 'Backup Dummy Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'dummy',
+                'method': 'credit_card',
+            }])
+        backup_profile = PaymentProfile.create_from_card(
+            self.party, self.party.addresses[0], backup_gateway, {
+                'owner': self.party.name,
+                'number': '4111111111111111',
+                'expiry_month': '05',
+                'expiry_year': '%s' % (Date.today().year + 3),
+                'csc': '435',
+            }
+        )
+        account_config = self.AccountConfiguration(1)
+        account_config.gateway_routing = True
+        account_config.save()
+
+        for _ in range(gateway_health.min_calls):
+            gateway_health.record(self.dummy_gateway.id, 30., True)
+        self.assertFalse(gateway_health.is_available(self.dummy_gateway.id))
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                invoice.amount_to_pay
+            )
+
+        transaction, = PaymentTransaction.search([
+            ('origin', '=', '%s,%s' % (invoice.__name__, invoice.id)),
+        ])
+        self.assertEqual(transaction.gateway, backup_gateway)
+        self.assertEqual(transaction.payment_profile, backup_profile)
+        self.assertEqual(invoice.state, 'paid')
+        self.assertEqual(
+            gateway_health.get_stats(backup_gateway.id)[0], 0.
+        )
+
+    @with_transaction()
+    def test_0150_test_payment_events_recorded(self):
+        """
+        Record the payment events of an invoice paid with a capture
+        """
+        PaymentEvent = POOL.get('account.invoice.payment_event')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            amount = invoice.amount_to_pay
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                amount
+            )
+
+        events = PaymentEvent.search([
+            ('invoice', '=', invoice.id),
+        ], order=[('id', 'ASC')])
+        self.assertEqual(
+            [e.event for e in events],
+            ['created', 'captured', 'paid', 'reconciled']
+        )
+        self.assertTrue(all(e.amount == amount for e in events))
+        self.assertEqual(events[0].transaction, events[2].transaction)
+
+        with self.assertRaises(UserError):
+            PaymentEvent.delete(events)
+
+    @with_transaction()
+    def test_0160_test_export_gateway_payments(self):
+        """
+        Export the invoices paid by gateway transactions to a CSV file
+        """
+        Date = POOL.get('ir.date')
+        Attachment = POOL.get('ir.attachment')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            amount = invoice.amount_to_pay
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                amount
+            )
+            self.create_and_post_invoice(self.party)
+
+            attachment = Attachment(self.Invoice.export_gateway_payments(
+                Date.today(), Date.today()
+            ))
+
+        self.assertEqual(attachment.resource, self.company)
+        rows = list(csv.DictReader(str(attachment.data).splitlines()))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['invoice'], str(invoice.id))
+        self.assertEqual(rows[0]['gateway'], self.dummy_gateway.name)
+        self.assertEqual(Decimal(rows[0]['amount']), amount)
+        self.assertEqual(rows[0]['reconciliation'], 'reconciled')
+
+    @with_transaction()
+    def test_0170_test_ingest_gateway_notifications(self):
+        """
+        Apply a batch of gateway notifications once and pay the invoice
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        Notification = POOL.get('account.invoice.payment_notification')
+
+        self.setup_defaults()
+
+        if not config.has_section('invoice_payment_gateway'):
+            config.add_section('invoice_payment_gateway')
+        config.set(
+            'invoice_payment_gateway', 'dummy_notification_secret', 'secret'
+        )
+        self.addCleanup(
+            config.remove_option, 'invoice_payment_gateway',
+            'dummy_notification_secret'
+        )
+
+        def sign(payload):
+            return hmac.new('secret', payload, hashlib.sha256).hexdigest()
+
+        account_config = self.AccountConfiguration(1)
+        account_config.authorize_on_post = True
+        account_config.save()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            transaction, = PaymentTransaction.search([
+                ('origin', '=', '%s,%s' % (invoice.__name__, invoice.id)),
+            ])
+            PaymentTransaction.write([transaction], {
+                'provider_reference': 'ch_0170',
+            })
+            notification = {
+                'event_id': 'evt_1',
+                'event': 'captured',
+                'provider_reference': 'ch_0170',
+                'amount': str(transaction.amount),
+            }
+            payload = json.dumps([notification, notification, {
+                'event_id': 'evt_2',
+                'event': 'captured',
+                'provider_reference': 'unknown',
+            }])
+
+            # Unsigned or forged payloads are refused
+            for signature in [None, '', sign(payload + ' ')]:
+                self.assertRaises(
+                    NotificationSignatureError, Notification.receive,
+                    self.dummy_gateway.id, payload, signature
+                )
+            self.assertFalse(Notification.search([]))
+            self.assertEqual(invoice.state, 'posted')
+
+            results = Notification.receive(
+                self.dummy_gateway.id, payload, sign(payload)
+            )
+            self.assertEqual(
+                [r['status'] for r in results],
+                ['processed', 'duplicate', 'ignored']
+            )
+            self.assertEqual(transaction.state, 'posted')
+            self.assertEqual(invoice.state, 'paid')
+
+            payload = json.dumps(notification)
+            results = Notification.receive(
+                self.dummy_gateway.id, payload, sign(payload)
+            )
+            self.assertEqual(results[0]['status'], 'duplicate')
+
+        ignored, = Notification.search([('state', '=', 'ignored')])
+        self.assertEqual(ignored.message, 'unknown_transaction')
+
+    @with_transaction()
+    def test_0180_test_charge_in_settlement_currency(self):
+        """
+        Convert the charges to the settlement currency of the gateway
+        """
+        self.setup_defaults()
+
+        usd = self.company.currency
+        eur = self.create_euro(Decimal('0.5'))
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            amount = invoice.amount_to_pay
+
+            self.assertEqual(
+                invoice.get_charge_amount(self.dummy_gateway, amount),
+                (usd, amount)
+            )
+
+            self.dummy_gateway.settlement_currency = eur
+            self.dummy_gateway.save()
+            rates = RateTable()
+            for _ in range(3):
+                self.assertEqual(
+                    invoice.get_charge_amount(
+                        self.dummy_gateway, amount, rates),
+                    (eur, amount / 2)
+                )
+            self.assertEqual(len(rates._rates), 1)
+
+    @with_transaction()
+    def test_0190_test_payment_plan_charges_installments(self):
+        """
+        Charge the installments of a payment plan when they are due
+        """
+        PaymentTerm = POOL.get('account.invoice.payment_term')
+        PaymentPlan = POOL.get('account.invoice.payment_plan')
+        Date = POOL.get('ir.date')
+
+        self.setup_defaults()
+
+        payment_term, = PaymentTerm.create([{
+            'name': 'Two Installments',
+            'lines': [('create', [{
+                'type': 'percent',
+                'ratio': Decimal('0.5'),
+                'divisor': Decimal('2'),
+                'relativedeltas': [('create', [{'days': 0}])],
+            }, {
+                'type': 'remainder',
+                'relativedeltas': [('create', [{'months': 1}])],
+            }])],
+        }])
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(
+                self.party, payment_term=payment_term
+            )
+            first, second = sorted(
+                invoice.lines_to_pay, key=lambda l: l.maturity_date
+            )
+            plan, = PaymentPlan.create([{
+                'invoice': invoice.id,
+                'payment_profile': self.dummy_cc_payment_profile.id,
+            }])
+            PaymentPlan.activate([plan])
+            self.assertEqual(plan.state, 'active')
+            self.assertEqual(plan.next_date, Date.today())
+
+            self.assertEqual(PaymentPlan.charge_due_plans(), [plan])
+            self.assertTrue(first.reconciliation)
+            self.assertFalse(second.reconciliation)
+            self.assertEqual(plan.next_date, second.maturity_date)
+
+            # The next installment is not due yet
+            self.assertEqual(PaymentPlan.charge_due_plans(), [])
+            self.assertEqual(invoice.amount_to_pay, Decimal('150'))
+
+    @with_transaction()
+    def test_0200_test_charge_run_priority_and_budget(self):
+        """
+        Order the invoices of a charge run by priority within a budget
+        """
+        ChargeRun = POOL.get('account.invoice.charge_run')
+        Shard = POOL.get('account.invoice.charge_run.shard')
+
+        self.setup_defaults()
+
+        # Keep the reservations in the transaction of the test
+        self.keep_commits()
+
+        def calls_spent():
+            # The calls are reserved with SQL queries
+            return ChargeRun.read([run.id], ['calls_spent'])[0]['calls_spent']
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('100')
+            )
+            credit_note = self.create_and_post_credit_note(self.party, 1)
+            run, = ChargeRun.create([{
+                'priority': 'amount',
+                'call_budget': 1,
+            }])
+            ChargeRun.start([run])
+
+        shard, = run.shards
+        self.assertEqual(
+            run.get_invoice_ids(shard.number), [invoice.id, credit_note.id]
+        )
+        first, second = shard.get_charge_order()
+        self.assertEqual(
+            [first.invoice, second.invoice], [invoice.id, credit_note.id]
+        )
+        self.assertEqual(first.profile, self.dummy_cc_payment_profile.id)
+        self.assertEqual(first.gateway, self.dummy_gateway.id)
+        self.assertEqual(first.amount, invoice.amount_to_pay)
+        self.assertEqual(first.amount, Decimal('200'))
+        self.assertEqual(first.state, 'pending')
+
+        # Invoices up to the cursor were already charged
+        shard.resume_cursor = '{"%s": ["%s", %s]}' % (
+            self.dummy_gateway.id, invoice.amount_to_pay, invoice.id
+        )
+        self.assertEqual(
+            [i.invoice for i in shard.get_charge_order()], [credit_note.id]
+        )
+
+        # The budget is shared by the workers through the run
+        budget = run.get_budget()
+        self.assertFalse(budget.exhausted)
+        self.assertEqual(budget.limit(run.chunk_size), 1)
+        self.assertEqual(calls_spent(), 1)
+        self.assertEqual(run.get_budget().limit(run.chunk_size), 0)
+        budget.spend(1)
+        self.assertTrue(budget.exhausted)
+        self.assertTrue(run.get_budget().exhausted)
+        self.assertIsNone(Shard.claim('worker1'))
+
+        # Calls reserved but not made are given back
+        ChargeRun.write([run], {'calls_spent': 0})
+        budget = run.get_budget()
+        self.assertEqual(budget.limit(run.chunk_size), 1)
+        budget.spend(0)
+        budget.close()
+        self.assertEqual(calls_spent(), 0)
+        self.assertEqual(Shard.claim('worker1'), shard)
+
+        # The time budget ends at a deadline of the run
+        ChargeRun.write([run], {
+            'deadline': datetime.datetime.now() - datetime.timedelta(1),
+        })
+        self.assertTrue(run.get_budget().exhausted)
+
+        # The next run resumes where the run stopped by its budget did
+        Shard.write([shard], {
+            'state': 'pending',
+            'lease_owner': None,
+            'lease_expiration': None,
+            'resume_cursor': shard.resume_cursor,
+        })
+        ChargeRun.finish([run])
+        self.assertEqual(
+            ChargeRun.read([run.id], ['state'])[0]['state'], 'done'
+        )
+        with Transaction().set_context(company=self.company.id):
+            next_run, = ChargeRun.create([{
+                'priority': 'amount',
+            }])
+            ChargeRun.start([next_run])
+        next_shard, = next_run.shards
+        self.assertEqual(next_shard.resume_cursor, shard.resume_cursor)
+        self.assertEqual(
+            [i.invoice for i in next_shard.get_charge_order()],
+            [credit_note.id]
+        )
+
+    @with_transaction()
+    def test_0210_test_pay_wizard_defaults_from_caches(self):
+        """
+        Pre-fill the gateway and payment profile of the pay wizard
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+
+        self.setup_defaults()
+
+        self.PaymentGateway.write([self.dummy_gateway], {
+            'users': [('add', [USER])],
+        })
+        self.assertEqual(
+            self.PaymentGateway.get_user_gateways(USER),
+            [self.dummy_gateway.id]
+        )
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+
+            Wizard = POOL.get(
+                'account.invoice.pay_using_transaction', type='wizard'
+            )
+            with Transaction().set_context(active_id=invoice.id):
+                pay_wizard = Wizard(Wizard.create()[0])
+                defaults = pay_wizard.default_start()
+
+            self.assertEqual(defaults['gateway'], self.dummy_gateway.id)
+            self.assertTrue(defaults['use_existing_card'])
+            self.assertEqual(
+                defaults['payment_profile'], self.dummy_cc_payment_profile.id
+            )
+
+            # A new profile invalidates the cached default profile
+            profile = self.create_payment_profile(
+                self.party, self.dummy_gateway
+            )
+            self.assertEqual(
+                PaymentProfile.get_default_profile(
+                    self.party.id, self.dummy_gateway.id),
+                profile.id
+            )
+
+    @with_transaction()
+    def test_0220_test_profile_payment(self):
+        """
+        Attach the profile of a payment to the invoice when enabled
+        """
+        Attachment = POOL.get('ir.attachment')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('100')
+            )
+            self.assertFalse(Attachment.search([
+                ('resource', '=', str(invoice)),
+            ]))
+
+            with Transaction().set_context(profile_payments=True):
+                invoice.capture_and_pay_using_transaction(
+                    self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                    Decimal('100')
+                )
+
+        attachment, = Attachment.search([
+            ('resource', '=', str(invoice)),
+        ])
+        self.assertTrue(
+            attachment.name.startswith(
+                'profile-capture_and_pay_using_transaction-')
+        )
+        self.assertIn('SQL:', attachment.data)
+
+    @with_transaction()
+    def test_0230_test_payment_balances(self):
+        """
+        Return the balances of the invoices of a party in one call
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            credit_note = self.create_and_post_credit_note(self.party, 1)
+
+            balance, credit_balance = \
+                self.Invoice.get_party_payment_balances([self.party.id])
+            self.assertEqual(balance['invoice'], invoice.id)
+            self.assertEqual(balance['amount'], invoice.amount_to_pay)
+            self.assertEqual(balance['transaction_type'], 'charge')
+            self.assertEqual(
+                balance['currency_digits'], invoice.currency_digits
+            )
+            self.assertEqual(
+                [p['id'] for p in balance['payment_profiles']],
+                [self.dummy_cc_payment_profile.id]
+            )
+            self.assertEqual(credit_balance['invoice'], credit_note.id)
+            self.assertEqual(credit_balance['transaction_type'], 'refund')
+            self.assertEqual(
+                credit_balance['amount'], abs(credit_note.amount_to_pay)
+            )
+
+            # A payment invalidates the cached balances
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('100')
+            )
+            balance, = self.Invoice.get_payment_balances([invoice])
+            self.assertEqual(balance['amount'], invoice.amount_to_pay)
+            self.assertEqual(
+                balance['amount_to_pay'], balance['amount_to_pay_today']
+            )
+
+    @with_transaction()
+    def test_0240_test_netted_credit_note_not_refunded(self):
+        """
+        Refuse to refund a credit note netted against an invoice
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        Wizard = POOL.get(
+            'account.invoice.pay_using_transaction', type='wizard'
+        )
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('50')
+            )
+            credit_note = self.create_and_post_credit_note(self.party, 10)
+            self.Invoice.net_credit_notes([invoice])
+
+            self.assertEqual(
+                self.Invoice.get_offset_invoice_ids([invoice, credit_note]),
+                set([credit_note.id])
+            )
+            self.assertEqual(credit_note.state, 'posted')
+            self.assertEqual(invoice.amount_to_pay, Decimal('150'))
+
+            # The wizard does not offer to refund it
+            with Transaction().set_context(active_id=credit_note.id):
+                pay_wizard = Wizard(Wizard.create()[0])
+                self.assertRaises(UserError, pay_wizard.default_start)
+
+                # Nor refunds it when started from a stale form
+                pay_wizard.start.invoice = credit_note
+                pay_wizard.start.party = self.party
+                pay_wizard.start.company = self.company
+                pay_wizard.start.credit_account = \
+                    self.party.account_receivable
+                pay_wizard.start.owner = self.party.name
+                pay_wizard.start.currency_digits = \
+                    credit_note.currency_digits
+                pay_wizard.start.amount = Decimal('100')
+                pay_wizard.start.user = USER
+                pay_wizard.start.gateway = self.dummy_gateway
+                pay_wizard.start.payment_profile = None
+                pay_wizard.start.transaction = None
+                pay_wizard.start.method = self.dummy_gateway.method
+                pay_wizard.start.transaction_type = 'refund'
+                self.assertRaises(UserError, pay_wizard.transition_pay)
+
+            self.assertRaises(
+                UserError, credit_note.create_refund_transactions,
+                Decimal('100')
+            )
+            self.assertFalse(PaymentTransaction.search([
+                ('type', '=', 'refund'),
+            ]))
+
+            balance, credit_balance = self.Invoice.get_payment_balances(
+                [invoice, credit_note]
+            )
+            self.assertEqual(balance['amount'], Decimal('150'))
+            self.assertFalse(balance['offset'])
+            self.assertTrue(credit_balance['offset'])
+            self.assertEqual(credit_balance['amount'], Decimal('0'))
+
+            # It is settled with the invoice
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                invoice.amount_to_pay
+            )
+        self.assertEqual(invoice.state, 'paid')
+        self.assertEqual(credit_note.state, 'paid')
+
+    @with_transaction()
+    def test_0250_test_charge_run_leases(self):
+        """
+        Claim, renew and reclaim the leases of the shards of a charge run
+        """
+        ChargeRun = POOL.get('account.invoice.charge_run')
+        Shard = POOL.get('account.invoice.charge_run.shard')
+
+        self.setup_defaults()
+
+        # Keep the leases in the transaction of the test
+        self.keep_commits()
+
+        def lease(shard):
+            # The leases are updated with SQL queries
+            return Shard.read([shard.id], [
+                'state', 'lease_owner', 'lease_expiration', 'invoice_count',
+                'charged_count', 'failed_count',
+            ])[0]
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            run, = ChargeRun.create([{}])
+            ChargeRun.start([run])
+
+            shard = Shard.claim('worker1')
+            self.assertEqual(shard, run.shards[0])
+            self.assertEqual(lease(shard)['state'], 'running')
+            self.assertEqual(lease(shard)['lease_owner'], 'worker1')
+            self.assertTrue(
+                lease(shard)['lease_expiration'] > datetime.datetime.now()
+            )
+            self.assertIsNone(Shard.claim('worker2'))
+
+            self.assertTrue(shard.renew_lease('worker1', 2, 1, 1))
+            self.assertFalse(shard.renew_lease('worker2'))
+            values = lease(shard)
+            self.assertEqual(
+                (
+                    values['invoice_count'], values['charged_count'],
+                    values['failed_count']
+                ), (2, 1, 1)
+            )
+
+            # The lease of a worker which stopped expires
+            Shard.write([shard], {
+                'lease_expiration': (
+                    datetime.datetime.now() - datetime.timedelta(minutes=1)
+                ),
+            })
+            self.assertFalse(shard.renew_lease('worker1'))
+            self.assertEqual(Shard.claim('worker2'), shard)
+            self.assertEqual(lease(shard)['lease_owner'], 'worker2')
+            self.assertFalse(shard.renew_lease('worker1'))
+
+            self.assertTrue(Shard(shard.id).charge('worker2'))
+            self.assertEqual(lease(shard)['state'], 'done')
+            self.assertIsNone(lease(shard)['lease_owner'])
+            self.assertEqual(run.state, 'done')
+            self.assertEqual(invoice.state, 'paid')
+
+            # Runs missed by workers finishing together are closed later
+            run2, = ChargeRun.create([{
+                'shard_count': 2,
+            }])
+            ChargeRun.start([run2])
+            ChargeRun.finish([run2])
+            self.assertEqual(run2.state, 'running')
+            Shard.write(list(run2.shards), {'state': 'done'})
+            ChargeRun.process()
+            self.assertEqual(run2.state, 'done')
+
+    @with_transaction()
+    def test_0260_test_lock_for_payment(self):
+        """
+        Lock the invoices to pay and only report the rows locked by others
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        class LockNotAvailable(DatabaseOperationalError):
+            pgcode = '55P03'
+
+        class SerializationFailure(DatabaseOperationalError):
+            pgcode = '40001'
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            invoice2 = self.create_and_post_invoice(self.party)
+
+            self.assertEqual(
+                self.Invoice.lock_for_payment([invoice, invoice2]),
+                [invoice, invoice2]
+            )
+            self.assertEqual(
+                self.Invoice.lock_for_payment(
+                    [invoice, invoice2], skip_locked=True
+                ), [invoice, invoice2]
+            )
+
+        self.assertTrue(
+            self.Invoice._is_lock_not_available(LockNotAvailable())
+        )
+        self.assertFalse(
+            self.Invoice._is_lock_not_available(SerializationFailure())
+        )
+        self.assertFalse(
+            self.Invoice._is_lock_not_available(DatabaseOperationalError())
+        )
+
+    def test_0270_test_gateway_routing(self):
+        """
+        Keep the healthy gateway asked for and allow a single trial capture
+        on a gateway whose circuit is open
+        """
+        health = GatewayHealth(min_calls=2, open_duration=30, timeout=10)
+
+        # A single error does not make a gateway unhealthy
+        health.record(5, 2., True)
+        self.assertTrue(health.is_healthy(5))
+        self.assertEqual(health.route([6, 5], preferred=5), 5)
+
+        # Slow calls are errors
+        health.record(7, 10., False)
+        health.record(7, 12., False)
+        self.assertFalse(health.is_healthy(7))
+        self.assertFalse(health.is_available(7))
+
+        # A gateway without history does not replace a healthy one
+        health.record(1, 2., False)
+        health.record(1, 2., False)
+        health.record(1, 2., True)
+        self.assertEqual(health.route([1, 2], preferred=1), 1)
+        self.assertEqual(health.route([1, 2]), 2)
+
+        # Ties keep the order of the gateways
+        self.assertEqual(health.route([3, 4]), 3)
+        self.assertEqual(health.route([4, 3]), 4)
+
+        for _ in range(2):
+            health.record(1, 2., True)
+        self.assertFalse(health.is_healthy(1))
+        self.assertFalse(health.is_available(1))
+        self.assertEqual(health.route([1, 2], preferred=1), 2)
+
+        # Once the open duration elapsed, a single capture is let through
+        health._opened[1] -= health.open_duration
+        self.assertEqual(health.sort([1]), [1])
+        self.assertTrue(health.is_available(1))
+        self.assertFalse(health.is_available(1))
+        self.assertEqual(health.sort([1]), [])
+        self.assertIsNone(health.route([1]))
+
+        # A failed trial opens the circuit again, a successful one closes it
+        health.record(1, 2., True)
+        self.assertFalse(health.is_available(1))
+        health._opened[1] -= health.open_duration
+        self.assertTrue(health.is_available(1))
+        health.record(1, 2., False)
+        self.assertTrue(health.is_available(1))
+        self.assertTrue(health.is_available(1))
+        self.assertTrue(health.is_healthy(1))
+
+    @with_transaction()
+    def test_0280_test_onboard_cards_in_threads(self):
+        """
+        Onboard cards from several workers, with a reference repeated
+        """
+        PaymentProfile = POOL.get('party.payment_profile')
+
+        self.setup_defaults()
+        self.keep_commits()
+
+        rows = [{
+            'reference': 'CUST-%s' % i,
+            'party': self.party.id,
+            'gateway': self.dummy_gateway.id,
+            'owner': self.party.name,
+            'number': '4111111111111111',
+            'expiry_month': '05',
+            'expiry_year': '2030',
+            'csc': '435',
+        } for i in range(5)]
+        rows.append(dict(rows[0]))
+
+        results = PaymentProfile.onboard_cards(rows, workers=2)
+
+        self.assertEqual(
+            [r['status'] for r in results], ['created'] * 5 + ['exists']
+        )
+        self.assertEqual(results[5]['profile'], results[0]['profile'])
+        self.assertEqual(
+            len(set(r['profile'] for r in results)), 5
+        )
+        profiles = PaymentProfile.browse([r['profile'] for r in results[:5]])
+        self.assertEqual(
+            [p.onboarding_reference for p in profiles],
+            ['CUST-%s' % i for i in range(5)]
+        )
+        self.assertTrue(all(p.provider_reference for p in profiles))
+
+    @with_transaction()
+    def test_0290_test_pay_foreign_currency_invoice(self):
+        """
+        Charge and pay invoices in a foreign currency on a gateway settling
+        in the currency of the company
+        """
+        self.setup_defaults()
+
+        usd = self.company.currency
+        eur = self.create_euro(Decimal('2'))
+        self.dummy_gateway.settlement_currency = usd
+        self.dummy_gateway.save()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice1 = self.create_and_post_invoice(self.party, currency=eur)
+            invoice2 = self.create_and_post_invoice(self.party, currency=eur)
+            self.assertEqual(invoice1.amount_to_pay, Decimal('300'))
+
+            invoice1.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                invoice1.amount_to_pay
+            )
+            transaction2, = self.Invoice.batch_capture_and_pay([invoice2])
+
+        self.assertEqual(transaction2.currency, usd)
+        self.assertEqual(transaction2.amount, Decimal('150'))
+        for invoice in self.Invoice.browse([invoice1.id, invoice2.id]):
+            self.assertEqual(invoice.state, 'paid')
+            self.assertEqual(invoice.amount_to_pay, Decimal('0'))
+            payment_line, = invoice.payment_lines
+            # Booked in the currency of the company
+            self.assertEqual(payment_line.credit, Decimal('150'))
+            self.assertEqual(payment_line.debit, Decimal('0'))
+
+        with Transaction().set_context(company=self.company.id):
+            # Simulated in the currency charged
+            invoice3 = self.create_and_post_invoice(self.party, currency=eur)
+            simulation = self.Invoice.simulate_batch_capture([invoice3])
+            charge, = simulation['charges']
+            self.assertEqual(charge['currency'], 'USD')
+            self.assertEqual(charge['amount'], Decimal('150'))
+
+            # Refunded from the charges in the settlement currency
+            credit_note = self.create_and_post_credit_note(
+                self.party, 10, currency=eur
+            )
+            self.assertEqual(credit_note.amount_to_pay, Decimal('-100'))
+            refund, = credit_note.create_refund_transactions(
+                credit_note.amount_to_pay
+            )
+        self.assertEqual(refund.currency, usd)
+        self.assertEqual(refund.amount, Decimal('50'))
+
+    @with_transaction()
+    def test_0300_test_renew_expiring_authorizations(self):
+        """
+        Authorize again the invoices whose authorization expires before
+        they are captured
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        PaymentTerm = POOL.get('account.invoice.payment_term')
+        Date = POOL.get('ir.date')
+
+        self.setup_defaults()
+
+        account_config = self.AccountConfiguration(1)
+        account_config.authorize_on_post = True
+        account_config.authorization_validity = 7
+        account_config.save()
+
+        payment_term, = PaymentTerm.create([{
+            'name': 'In a Month',
+            'lines': [('create', [{
+                'type': 'remainder',
+                'relativedeltas': [('create', [{'months': 1}])],
+            }])],
+        }])
+
+        def authorizations(invoice):
+            return PaymentTransaction.search([
+                ('origin', '=', '%s,%s' % (invoice.__name__, invoice.id)),
+            ], order=[('id', 'ASC')])
+
+        with Transaction().set_context(company=self.company.id):
+            later = self.create_and_post_invoice(
+                self.party, payment_term=payment_term
+            )
+            due = self.create_and_post_invoice(self.party)
+            old_later, = authorizations(later)
+            old_due, = authorizations(due)
+
+            # Still valid: only the invoice due is captured
+            self.assertEqual(
+                self.Invoice.capture_authorized_transactions(), [old_due]
+            )
+            self.assertEqual(due.state, 'paid')
+            self.assertEqual(old_later.state, 'authorized')
+
+            PaymentTransaction.write([old_later], {
+                'date': Date.today() - datetime.timedelta(days=6),
+            })
+            self.assertEqual(
+                self.Invoice.capture_authorized_transactions(), []
+            )
+
+        self.assertEqual(old_later.state, 'cancel')
+        _, new_later = authorizations(later)
+        self.assertEqual(new_later.state, 'authorized')
+        self.assertEqual(new_later.date, Date.today())
+        self.assertEqual(new_later.amount, later.amount_to_pay)
+        self.assertEqual(later.state, 'posted')
+
+    @with_transaction()
+    def test_0310_test_chargeback_notification(self):
+        """
+        Reverse the payment of an invoice when its charge is charged back
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        Notification = POOL.get('account.invoice.payment_notification')
+        PaymentEvent = POOL.get('account.invoice.payment_event')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                invoice.amount_to_pay
+            )
+            self.assertEqual(invoice.state, 'paid')
+            charge, = PaymentTransaction.search([
+                ('origin', '=', '%s,%s' % (invoice.__name__, invoice.id)),
+            ])
+            PaymentTransaction.write([charge], {
+                'provider_reference': 'ch_0310',
+            })
+
+            results = Notification.ingest([{
+                'event_id': 'evt_1',
+                'gateway': self.dummy_gateway.id,
+                'event': 'chargeback',
+                'provider_reference': 'ch_0310',
+                'amount': Decimal('400'),
+            }, {
+                'event_id': 'evt_2',
+                'gateway': self.dummy_gateway.id,
+                'event': 'chargeback',
+                'provider_reference': 'ch_0310',
+            }])
+
+        self.assertEqual(
+            [r['status'] for r in results], ['ignored', 'processed']
+        )
+        ignored, = Notification.search([('event_id', '=', 'evt_1')])
+        self.assertEqual(ignored.message, 'amount_mismatch')
+
+        refund, = PaymentTransaction.search([('type', '=', 'refund')])
+        self.assertEqual(refund.amount, charge.amount)
+        self.assertEqual(refund.state, 'posted')
+        invoice = self.Invoice(invoice.id)
+        self.assertEqual(invoice.state, 'posted')
+        self.assertEqual(invoice.amount_to_pay, Decimal('300'))
+        event, = PaymentEvent.search([
+            ('event', '=', 'chargeback'), ('invoice', '=', invoice.id),
+        ])
+        self.assertEqual(event.transaction, refund)
+
+    @with_transaction()
+    def test_0320_test_amounts_to_pay_of_partly_paid_foreign_invoice(self):
+        """
+        Count the payments in the currency of the company of a foreign
+        invoice in the amounts to pay computed in bulk
+        """
+        self.setup_defaults()
+
+        usd = self.company.currency
+        eur = self.create_euro(Decimal('2'))
+        self.dummy_gateway.settlement_currency = usd
+        self.dummy_gateway.save()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party, currency=eur)
+            invoice.capture_and_pay_using_transaction(
+                self.dummy_cc_payment_profile.id, self.dummy_gateway.id,
+                Decimal('100')
+            )
+            invoice = self.Invoice(invoice.id)
+            payment_line, = invoice.payment_lines
+            self.assertEqual(payment_line.credit, Decimal('50'))
+            self.assertEqual(payment_line.amount_second_currency, None)
+            self.assertEqual(invoice.amount_to_pay, Decimal('200'))
+
+            self.assertEqual(
+                self.Invoice._get_amounts_to_pay([invoice.id]),
+                {invoice.id: (Decimal('200'), Decimal('200'))}
+            )
+            balance, = self.Invoice.get_payment_balances([invoice])
+            self.assertEqual(balance['amount_to_pay'], Decimal('200'))
+
+    @unittest.skipIf(
+        backend.name() != 'postgresql', 'Only PostgreSQL locks invoice rows'
+    )
+    @with_transaction()
+    def test_0330_test_invoice_locked_by_another_transaction(self):
+        """
+        Skip an invoice locked by another transaction in a batch capture and
+        refuse to pay it
+        """
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            invoice = self.create_and_post_invoice(self.party)
+            payment_transaction = invoice._get_payment_transaction(
+                self.dummy_cc_payment_profile, self.dummy_gateway,
+                invoice.amount_to_pay
+            )
+            payment_transaction.save()
+            PaymentTransaction.capture([payment_transaction])
+            # The other transaction can only lock a committed invoice
+            Transaction().commit()
+
+            database = Transaction().database
+            connection = database.get_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(
+                    'SELECT id FROM account_invoice WHERE id = %s '
+                    'FOR UPDATE', (invoice.id,)
+                )
+
+                self.assertEqual(
+                    self.Invoice.batch_capture_and_pay([invoice]), []
+                )
+                self.assertFalse(self.Invoice(invoice.id).payment_lines)
+                # Last, the failed NOWAIT lock aborts the transaction
+                with self.assertRaises(UserError):
+                    invoice.pay_using_transaction(payment_transaction)
+            finally:
+                connection.rollback()
+                database.put_connection(connection)
+
 
 def suite():
     "Define suite"